@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Замеры скорости и памяти для этапов построения таблицы рекомендаций.
+
+Без доступа к схеме `final` данные генерируются: таблицы той же структуры, что `final.carts` и
+`final.cart_items`, с популярностью курсов по степенному закону (закон Ципфа) и настраиваемым
+размером корзины.  Генератор детерминирован (задаётся seed), поэтому замеры повторяемы.
+
+Для каждого сочетания «число покупателей × число курсов» последовательно выполняются этапы:
+
+  - `pairs_python` — подсчёт пар в Python по спискам курсов покупателей (как движок 'python');
+  - `copy_decode`  — декодирование потока COPY в двоичном формате, поданного по одной строке за вызов
+                     write (так его передаёт `cursor.copy_expert`);
+  - `pairs_arrays` — векторный подсчёт пар по массивам (как движок 'copy');
+  - `pairs_approx` — приближённый подсчёт пар (как движок 'approx'), в запись добавляется отчёт
+                     о точности по сравнению с точным подсчётом (`approx_accuracy`);
+  - `matrix`       — построение разреженной матрицы пар (`make_pairs_matrix`);
+  - `recommend`    — таблица рекомендаций (`recommend_top_k`).
+
+Для каждого этапа записываются время и пиковый объём памяти процесса (VmHWM из /proc, перед этапом
+пик сбрасывается).  Результаты пишутся в JSON.  Если указан файл с результатами прошлого прогона
+(`--baseline`), этапы, ставшие медленнее или «тяжелее» более чем в `--tolerance` раз, считаются
+регрессией, и программа завершается с кодом 1.
+
+Пример:
+    ./final_proj_benchmark.py --users 10000 100000 --courses 100 1000 --report bench.json
+    ./final_proj_benchmark.py --full --baseline bench.json
+"""
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from final_proj_recommendations import (_CopyBinaryDecoder, approx_accuracy, approx_pairs_count,
+                                        count_pairs_from_arrays, count_pairs_from_lists, make_pairs_matrix,
+                                        pgcopy_int4_row, pgcopy_int4_rows, recommend_top_k, user_course_arrays,
+                                        PGCOPY_SIGNATURE, RECS_COUNT, SKETCH_CANDIDATES, SKETCH_DEPTH, SKETCH_WIDTH)
+
+FULL_USERS = [10_000, 100_000, 1_000_000, 10_000_000]
+FULL_COURSES = [100, 1_000, 10_000]
+STAGES = ['pairs_python', 'copy_decode', 'pairs_arrays', 'pairs_approx', 'matrix', 'recommend']
+MIN_SECONDS = 0.05  # более короткие этапы не проверяются на регрессию: слишком велик шум
+MIN_MEMORY_MB = 16
+
+def generate_carts(n_users: int, n_courses: int, seed=0, alpha=1.1, mean_basket=1.5,
+                   carts_per_user=1.3, success_share=0.6) -> (pd.DataFrame, pd.DataFrame):
+    """Генерирует таблицы той же структуры, что final.carts и final.cart_items.
+    Параметры: число покупателей и курсов, seed, показатель степенного закона популярности,
+    средний размер корзины, среднее число корзин на покупателя, доля успешных корзин.
+    Возвращает кортеж DataFrame-ов (carts, cart_items)"""
+    rng = np.random.default_rng(seed)
+    popularity = 1.0 / np.arange(1, n_courses + 1) ** alpha
+    popularity /= popularity.sum()
+    course_ids = 356 + rng.permutation(n_courses)  # ID не связаны с популярностью
+
+    n_user_carts = 1 + rng.poisson(carts_per_user - 1, n_users)
+    n_carts = int(n_user_carts.sum())
+    successful = rng.random(n_carts) < success_share
+    purchased_at = (np.datetime64('2017-01-01T00:00:00')
+                    + rng.integers(0, 2 * 365 * 24 * 3600, n_carts).astype('timedelta64[s]'))
+    carts = pd.DataFrame({
+        'id': np.arange(1, n_carts + 1),
+        'user_id': np.repeat(np.arange(1, n_users + 1), n_user_carts),
+        'state': pd.Categorical.from_codes(np.where(successful, 0, 1), ['successful', 'cancelled']),
+        'purchased_at': np.where(successful, purchased_at, np.datetime64('NaT')),
+    })
+
+    n_cart_items = 1 + rng.poisson(mean_basket - 1, n_carts)
+    n_items = int(n_cart_items.sum())
+    is_course = rng.random(n_items) < 0.9
+    cart_items = pd.DataFrame({
+        'id': np.arange(1, n_items + 1),
+        'cart_id': np.repeat(carts['id'].to_numpy(), n_cart_items),
+        'resource_type': pd.Categorical.from_codes(np.where(is_course, 0, 1), ['Course', 'Webinar']),
+        'resource_id': course_ids[rng.choice(n_courses, size=n_items, p=popularity)],
+    })
+    return carts, cart_items
+
+# Память: пиковый RSS процесса (VmHWM), который в Linux можно сбросить перед этапом
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def _rss_mb(field: str) -> float:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # без /proc — пик за всё время работы процесса
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(stage: str, func, *args):
+    "Выполняет этап, возвращает (результат, запись с временем и памятью)"
+    _reset_peak_rss()
+    rss_before = _rss_mb('VmRSS')
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = _rss_mb('VmHWM')
+    return result, {'stage': stage, 'seconds': round(seconds, 4),
+                    'peak_rss_mb': round(peak, 1), 'rss_delta_mb': round(max(peak - rss_before, 0), 1)}
+
+def _users_courses_lists(users: np.ndarray, courses: np.ndarray) -> list:
+    "Списки курсов по покупателям, как их получает движок 'python' (только покупатели 2+ курсов)"
+    order = np.argsort(users, kind='stable')
+    users, courses = users[order], courses[order]
+    bounds = np.flatnonzero(np.diff(users)) + 1
+    return [group for group in np.split(courses, bounds) if len(np.unique(group)) > 1]
+
+def decode_copy_rows(data: bytes, row_size: int) -> tuple:
+    "Подаёт поток COPY в декодер так же, как copy_expert: заголовок, затем по сообщению на строку"
+    decoder = _CopyBinaryDecoder()
+    header = len(PGCOPY_SIGNATURE) + 8
+    decoder.write(data[:header])
+    view = memoryview(data)
+    for start in range(header, len(data), row_size):
+        decoder.write(view[start:start + row_size])
+    return decoder.arrays()
+
+def run_case(n_users: int, n_courses: int, stages: list, args) -> list:
+    "Прогон всех этапов для одного размера данных"
+    carts, cart_items = generate_carts(n_users, n_courses, args.seed, args.alpha, args.mean_basket)
+    users, courses = user_course_arrays(carts, cart_items)
+    del carts, cart_items
+    buyers = pd.Series(users).groupby(courses).nunique().sort_values(ascending=False, kind='stable')
+    records = []
+    pairs_count = None
+    if 'pairs_python' in stages:
+        lists = [group.tolist() for group in _users_courses_lists(users, courses)]
+        pairs_count, record = measure('pairs_python', count_pairs_from_lists, lists)
+        records.append(record)
+        del lists
+    if 'copy_decode' in stages:
+        data = pgcopy_int4_rows([users, courses])
+        (decoded, _), record = measure('copy_decode', decode_copy_rows, data, pgcopy_int4_row(2).itemsize)
+        assert((decoded == users).all())
+        records.append(record)
+        del data, decoded
+    if 'pairs_arrays' in stages or pairs_count is None:
+        python_count = pairs_count
+        pairs_count, record = measure('pairs_arrays', count_pairs_from_arrays, users, courses)
+        assert(python_count is None or python_count == pairs_count)
+        if 'pairs_arrays' in stages:
+            records.append(record)
+    if 'pairs_approx' in stages:
+        approx_count, record = measure('pairs_approx', approx_pairs_count, users, courses,
+                                       args.sketch_width, SKETCH_DEPTH, args.sketch_candidates)
+        record.update(approx_accuracy(pairs_count, approx_count, buyers.index, args.k))
+        records.append(record)
+        del approx_count
+    matrix, record = measure('matrix', make_pairs_matrix, pairs_count, buyers.index)
+    if 'matrix' in stages:
+        records.append(record)
+    if 'recommend' in stages:
+        _, record = measure('recommend', recommend_top_k, matrix, buyers.index, buyers, args.k)
+        records.append(record)
+    for record in records:
+        record.update(users=n_users, courses=n_courses, rows=int(len(users)))
+    return records
+
+def find_regressions(results: list, baseline: list, tolerance: float) -> list:
+    "Сравнивает результаты с прошлым прогоном, возвращает список описаний регрессий"
+    key = lambda r: (r['stage'], r['users'], r['courses'])
+    previous = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        if result['seconds'] > max(old['seconds'], MIN_SECONDS) * tolerance:
+            regressions.append(f"{key(result)}: {old['seconds']}s -> {result['seconds']}s")
+        if result['rss_delta_mb'] > max(old['rss_delta_mb'], MIN_MEMORY_MB) * tolerance:
+            regressions.append(f"{key(result)}: {old['rss_delta_mb']}MB -> {result['rss_delta_mb']}MB")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Замеры этапов построения таблицы рекомендаций")
+    parser.add_argument('--users', type=int, nargs='+', default=[10_000, 100_000], help="числа покупателей")
+    parser.add_argument('--courses', type=int, nargs='+', default=[100, 1_000], help="числа курсов")
+    parser.add_argument('--full', action='store_true',
+                        help=f"полная сетка: покупатели {FULL_USERS}, курсы {FULL_COURSES}")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help="какие этапы замерять")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=1.1, help="показатель степенного закона популярности")
+    parser.add_argument('--mean-basket', type=float, default=1.5, help="средний размер корзины")
+    parser.add_argument('-k', type=int, default=RECS_COUNT, help="количество рекомендаций на курс")
+    parser.add_argument('--sketch-width', type=int, default=SKETCH_WIDTH, help="ширина скетча для pairs_approx")
+    parser.add_argument('--sketch-candidates', type=int, default=SKETCH_CANDIDATES,
+                        help="кандидатов в партнёры на курс для pairs_approx")
+    parser.add_argument('--report', default='bench_results.json', help="куда записать результаты (JSON)")
+    parser.add_argument('--baseline', help="результаты прошлого прогона для поиска регрессий")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="во сколько раз этап может стать медленнее (или тяжелее), прежде чем это регрессия")
+    args = parser.parse_args(argv)
+    users_grid, courses_grid = (FULL_USERS, FULL_COURSES) if args.full else (args.users, args.courses)
+
+    results = []
+    for n_users in users_grid:
+        for n_courses in courses_grid:
+            for record in run_case(n_users, n_courses, args.stages, args):
+                print(json.dumps(record), file=sys.stderr)
+                results.append(record)
+    with open(args.report, 'w') as report:
+        json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                   'seed': args.seed, 'results': results}, report, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = find_regressions(results, json.load(baseline)['results'], args.tolerance)
+        for regression in regressions:
+            print("Regression: " + regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Сервис выдачи рекомендаций по ID курса.
+
+Загружает таблицу рекомендаций (CSV, который печатает `final_proj_recommendations.py`
+в пакетном режиме) в массив NumPy, где номер строки — это ID курса, и отвечает на запросы
+вида «ID курса -> [рекомендация 1, рекомендация 2, ...]».  Поиск — одно обращение к массиву
+по индексу, без pandas.  Файл `.npy` (`final_proj_recommendations.py --format npy`) уже содержит
+такой массив: он отображается в память (mmap) без разбора и копирования.
+
+Когда файл таблицы меняется (новую таблицу нужно публиковать через переименование файла,
+чтобы сервис не прочёл её наполовину записанной), сервис перечитывает его в фоне и подменяет
+массив целиком.
+
+Протоколы:
+  - HTTP: `GET /recommendations/489` -> `{"489": [551, 566]}`,
+          `GET /recommendations?ids=489,490` -> `{"489": [...], "490": [...]}`;
+  - Unix-сокет: строка с ID через пробел -> строка JSON того же вида.
+Для неизвестного курса возвращается пустой список.
+Общая таблица по сегментам (с колонкой `segment`) не поддерживается: сервис выдаёт одну таблицу.
+"""
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+NO_COURSE = -1
+
+class RecTable:
+    """Таблица рекомендаций, загруженная из файла: массив (max_ID + 1) × K,
+    строки курсов без рекомендаций заполнены NO_COURSE"""
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.recs = load_table(path)
+
+    def lookup(self, course_ids: "list of int") -> dict:
+        "Рекомендации для списка курсов в виде {ID: [рекомендации]}"
+        recs = self.recs
+        result = {}
+        for course_id in course_ids:
+            if 0 <= course_id < len(recs):
+                row = recs[course_id]
+                result[course_id] = row[row != NO_COURSE].tolist()
+            else:
+                result[course_id] = []
+        return result
+
+def load_table(path: str) -> np.ndarray:
+    """Читает таблицу рекомендаций и возвращает массив, индексированный ID курса.
+    Файл .npy отображается в память как есть, CSV (первая колонка — ID курса,
+    остальные — рекомендации) разбирается"""
+    if path.endswith('.npy'):
+        recs = np.load(path, mmap_mode='r')
+        if recs.dtype != np.int32 or recs.ndim != 2:
+            raise ValueError(f"{path}: expected 2D int32 array, got {recs.ndim}D {recs.dtype}")
+        return recs
+    with open(path) as table_file:
+        header = table_file.readline().strip().split(',')
+    if header[0] == 'segment':
+        raise ValueError(f"{path}: table by segments (build --segment) is not supported, serve a single table")
+    data = np.loadtxt(path, delimiter=',', skiprows=1, dtype=np.int64, ndmin=2)
+    recs = np.full((int(data[:, 0].max(initial=-1)) + 1, data.shape[1] - 1), NO_COURSE, dtype=np.int32)
+    recs[data[:, 0]] = data[:, 1:]
+    return recs
+
+def watch_table(holder: dict, interval: float, stop: threading.Event):
+    "Раз в interval секунд проверяет время изменения файла и подменяет holder['table']"
+    while not stop.wait(interval):
+        table = holder['table']
+        try:
+            if os.stat(table.path).st_mtime != table.mtime:
+                holder['table'] = RecTable(table.path)
+        except (OSError, ValueError) as err:
+            # Файл могут как раз заменять; работаем со старой таблицей и пробуем в следующий раз
+            print(f"Table reload failed: {err}", file=sys.stderr)
+
+def parse_ids(text: str) -> list:
+    "Разбирает список ID курсов, разделённых запятыми и/или пробелами"
+    return [int(i) for i in text.replace(',', ' ').split()]
+
+def make_http_handler(holder: dict):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive: клиент может не открывать соединение на каждый запрос
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            try:
+                if url.path.startswith('/recommendations/'):
+                    ids = parse_ids(url.path[len('/recommendations/'):])
+                elif url.path == '/recommendations':
+                    ids = parse_ids(','.join(parse_qs(url.query).get('ids', [])))
+                else:
+                    self.send_error(404)
+                    return
+            except ValueError:
+                self.send_error(400, "Course IDs must be integers")
+                return
+            body = json.dumps(holder['table'].lookup(ids)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            return  # запросов много, журнал каждого не нужен
+    return Handler
+
+def make_unix_handler(holder: dict):
+    class Handler(socketserver.StreamRequestHandler):
+        "Построчный протокол: строка с ID через пробел -> строка JSON"
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    answer = holder['table'].lookup(parse_ids(line.decode()))
+                except ValueError:
+                    answer = {'error': "Course IDs must be integers"}
+                self.wfile.write(json.dumps(answer).encode() + b'\n')
+    return Handler
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Сервис выдачи рекомендаций по ID курса")
+    parser.add_argument('table', help="файл с таблицей рекомендаций (.csv или .npy)")
+    parser.add_argument('--host', default='127.0.0.1', help="адрес HTTP сервера")
+    parser.add_argument('--port', type=int, default=8089, help="порт HTTP сервера (0 — не запускать)")
+    parser.add_argument('--unix', help="путь к Unix-сокету (по умолчанию не используется)")
+    parser.add_argument('--reload-interval', type=float, default=5.0,
+                        help="как часто проверять обновление таблицы, секунд")
+    args = parser.parse_args(argv)
+
+    holder = {'table': RecTable(args.table)}
+    stop = threading.Event()
+    threading.Thread(target=watch_table, args=(holder, args.reload_interval, stop), daemon=True).start()
+
+    servers = []
+    if args.unix:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        servers.append(ThreadingUnixServer(args.unix, make_unix_handler(holder)))
+    if args.port:
+        servers.append(ThreadingHTTPServer((args.host, args.port), make_http_handler(holder)))
+    if not servers:
+        parser.error("nothing to serve: set --port and/or --unix")
+    for server in servers[1:]:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        servers[0].serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for server in servers:
+            server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
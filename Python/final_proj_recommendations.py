@@ -13,14 +13,23 @@
 #   - [Описание данных](#describe_data)
 # * [Программа, расчёты и визуализации](#program)
 #   - [Определения констант и функций](#const)
+#     + [Замеры времени и памяти](#instrumentation)
+#     + [Сводная статистика для отчётов](#summary_stats)
 #     + [Функции для работы с базой данных](#db_functions)
 #     + [Функции, связанные с интерактивной работой в Jupyter Notebook](#nb_functions)
 #     + [Константы для создания SQL запросов](#const_cte)
 #     + [Функции для получения конкретных данных из базы](#data_gather)
+#     + [Локальные источники данных](#local_sources)
+#     + [Инкрементальное обновление данных](#incremental)
 #     + [Построение матрицы сочетаний курсов](#matrix_create)
+#     + [Снимок данных](#snapshot)
+#     + [Последовательности покупок](#sequences)
 #     + [Построение таблицы рекомендаций](#recommendations)
+#     + [Рекомендации по сегментам](#segments)
+#     + [Загрузка данных](#load_data)
 #     + [Функция для интерактивной работы (Jupyter notebook или iPython)](#interactive)
-#     + [Функция для пакетной работы](#batch)
+#     + [Кэш результатов](#result_cache)
+#     + [Функции для пакетной работы](#batch)
 #   - [Основная точка входа в программу](#exec_point)
 #   - [Распечатка выходных данных и визуализации](#output)
 
@@ -44,8 +53,8 @@
 #
 # При запуске программа `final_proj_recommendations.py` запрашивает текущие данные о продажах
 # курсов из БД, строит по ним таблицу рекомендаций и печатает эту таблицу на стандартный
-# вывод в CSV формате.  Возможна доработка программы для выдачи других форматов или
-# работы в составе API.
+# вывод в CSV формате.  Таблицу можно также выдать в файл Parquet, в двоичный файл для
+# чтения через mmap (его использует сервис `final_proj_rec_server.py`) или в таблицу базы.
 #
 # %% [markdown]
 # ### Принцип генерации таблицы <a name='res.principle'/>
@@ -132,27 +141,197 @@
 # %% [markdown]
 # Подключение модулей, определение констант
 
+# %% [markdown]
+# Модули для графиков и ноутбука (matplotlib, seaborn, IPython) загружаются заметное время, а в пакетном
+# режиме не нужны вовсе.  Поэтому они импортируются внутри тех функций, которые рисуют или выводят
+# что-то в ноутбук, а здесь подключается только то, что нужно для расчётов.  Время импорта
+# запоминается: пакетный запуск должен укладываться в бюджет холодного старта.
 # %%
+import time
+_START_TIME = time.perf_counter()
 import pandas as pd
 import numpy as np
 import psycopg2
+import argparse
+import io
 import math
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import seaborn as sns
+import multiprocessing
+import os
+import pickle
+import resource
+import sqlite3
+import sys
+import cProfile
+import json
+import hashlib
+from scipy import sparse
 from psycopg2.extras import NamedTupleCursor
 from itertools import combinations
 from itertools import chain
-from functools import partial
+from itertools import count
 from collections import Counter
+from datetime import timedelta
+from collections.abc import Mapping
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextlib import nullcontext
 # -- on my local machine, I keep passwords in separate files
 # from LocalPostgres import DB_CONNECT_STRING
 from SkillFactory_DB import DB_CONNECT_STRING
-from matplotlib.axes._axes import _log as matplotlib_axes_logger
-from IPython.display import HTML
+IMPORT_TIME = time.perf_counter() - _START_TIME
 
 # %% [markdown]
 # ### Определения констант и функций <a name='const'/>
+# %% [markdown]
+# #### Замеры времени и памяти <a name='instrumentation'/>
+# %% [markdown]
+# Когда ночной расчёт замедляется, нужно понять, какой этап виноват: запросы в базу, подсчёт пар,
+# построение матрицы или таблицы рекомендаций.  Этапы расчёта обёрнуты в `stage(...)`, который, если
+# замеры включены (`start_run_report`), записывает время этапа, число строк и объём данных,
+# полученных из базы, и пиковый объём памяти процесса (peak RSS) на момент окончания этапа.
+# Итог сохраняется в JSON (`finish_run_report`).  Если замеры выключены, `stage` ничего не делает.
+# Пакетный режим кладёт в отчёт и сводную статистику популярности курсов и пар (`report_summary`).
+#
+# Объём данных для обычных запросов оценивается по длине текстового представления значений
+# (psycopg2 не сообщает, сколько байт пришло по сети), для COPY он точный.  Время этапа потокового
+# запроса включает обработку строк вызывающим кодом.  Процессы параллельного подсчёта пар не замеряются.
+# %%
+_run_report = None   # отчёт о запуске; None — замеры выключены
+_open_stages = []
+
+def start_run_report(command: str):
+    "Включает замеры этапов"
+    global _run_report
+    _run_report = {'command': command, 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                   'import_seconds': round(IMPORT_TIME, 6), 'stages': [], '_start': time.perf_counter()}
+
+def finish_run_report(path: str):
+    "Выключает замеры и записывает отчёт в JSON файл"
+    global _run_report
+    report, _run_report = _run_report, None
+    report['total_seconds'] = round(time.perf_counter() - report.pop('_start'), 6)
+    report['rows'] = sum(record['rows'] for record in report['stages'])
+    report['bytes'] = sum(record['bytes'] for record in report['stages'])
+    report['peak_rss_mb'] = _peak_rss_mb()
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=1)
+    return report
+
+def _peak_rss_mb() -> float:
+    "Пиковый объём памяти процесса с начала работы, МБ (ru_maxrss в Linux — в килобайтах)"
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def _rows_bytes(rows) -> int:
+    "Оценка объёма полученных строк по длине текстового представления значений"
+    return sum(len(str(value)) for row in rows for value in row)
+
+@contextmanager
+def stage(name: str):
+    """Замер этапа. Внутри блока доступна запись этапа (dict), в которую можно добавить
+    'rows' и 'bytes'; если замеры выключены, вместо записи — None"""
+    if _run_report is None:
+        yield None
+        return
+    record = {'stage': name, 'parent': _open_stages[-1]['stage'] if _open_stages else None,
+              'rows': 0, 'bytes': 0}
+    _open_stages.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        record['peak_rss_mb'] = _peak_rss_mb()
+        _open_stages.remove(record)
+        _run_report['stages'].append(record)
+
+def report_summary(name: str, stats: dict):
+    "Добавляет в отчёт о запуске сводную статистику (см. summary_stats), если замеры включены"
+    if _run_report is None:
+        return
+    def _key(key):
+        return sorted(key) if isinstance(key, frozenset) else key
+    _run_report.setdefault('summary', {})[name] = {
+        **stats,
+        'top': [[_key(key), value] for (key, value) in stats['top']],
+        'bottom': [[_key(key), value] for (key, value) in stats['bottom']],
+        'quantiles': {str(q): value for (q, value) in stats['quantiles'].items()}}
+    return
+
+# %% [markdown]
+# #### Сводная статистика для отчётов <a name='summary_stats'/>
+# %% [markdown]
+# Отчёты (верхние и нижние курсы и пары, порог непопулярности, распределение популярности) раньше
+# получали всё через полную сортировку счётчиков (`most_common()` без ограничения), и каждый отчёт
+# сортировал заново.  `summary_stats` за один проход по массиву значений находит всё сразу без полной
+# сортировки: верхние и нижние N — частичным выбором (`np.argpartition`), квантили — `np.quantile`
+# (тоже частичный выбор, линейная интерполяция, как у `pd.Series.quantile`), гистограмму — по
+# логарифмическим (если все значения положительны) или линейным корзинам.
+#
+# Верхние и нижние N выдаются в том же порядке, в каком их дал бы `most_common()`: по убыванию
+# значения, при равенстве — в порядке счётчика.  Принимаются `Counter`, `PairCounts` и `pd.Series`.
+# %%
+SUMMARY_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+SUMMARY_BINS = 20
+
+def _top_positions(values: np.ndarray, n: int) -> np.ndarray:
+    "Позиции n наибольших значений (при равенстве — меньшие позиции) в порядке most_common"
+    if n >= len(values):
+        selected = np.arange(len(values))
+    elif n <= 0:
+        selected = np.empty(0, dtype=np.intp)
+    else:
+        kth = np.partition(values, len(values) - n)[len(values) - n]
+        above = np.flatnonzero(values > kth)
+        selected = np.concatenate([above, np.flatnonzero(values == kth)[:n - len(above)]])
+    return selected[np.lexsort((selected, -values[selected]))]
+
+def _bottom_positions(values: np.ndarray, n: int) -> np.ndarray:
+    "Позиции n наименьших значений — последние n в порядке most_common, в этом же порядке"
+    if n >= len(values):
+        selected = np.arange(len(values))
+    elif n <= 0:
+        selected = np.empty(0, dtype=np.intp)
+    else:
+        kth = np.partition(values, n - 1)[n - 1]
+        below = np.flatnonzero(values < kth)
+        ties = np.flatnonzero(values == kth)
+        selected = np.concatenate([below, ties[len(ties) - (n - len(below)):]])
+    return selected[np.lexsort((selected, -values[selected]))]
+
+def summary_stats(counts: "Counter, PairCounts or pd.Series", n=5, quantiles=SUMMARY_QUANTILES,
+                  bins=SUMMARY_BINS) -> dict:
+    """Сводная статистика счётчика без полной сортировки.
+    Параметры: 1) счётчик, 2) сколько верхних и нижних элементов выдать, 3) квантили,
+    4) число корзин гистограммы (0 — гистограмма не нужна).
+    Возвращает словарь: count, total, top и bottom (списки пар (ключ, значение)),
+    quantiles ({квантиль: значение}), histogram ({'counts': [...], 'edges': [...]})"""
+    if isinstance(counts, PairCounts):
+        values = counts.counts
+        first, second = counts.pairs()
+        keys_at = lambda positions: [frozenset(pair) for pair in zip(first[positions].tolist(),
+                                                                     second[positions].tolist())]
+    elif isinstance(counts, pd.Series):
+        values = counts.to_numpy()
+        keys_at = lambda positions: counts.index[positions].tolist()
+    else:
+        keys = list(counts.keys())
+        values = np.fromiter(counts.values(), dtype=np.float64 if counts_dtype(counts).kind == 'f' else np.int64,
+                             count=len(keys))
+        keys_at = lambda positions: [keys[i] for i in positions.tolist()]
+    stats = {'count': len(values), 'total': values.sum().item()}
+    for (name, positions) in (('top', _top_positions(values, n)), ('bottom', _bottom_positions(values, n))):
+        stats[name] = list(zip(keys_at(positions), values[positions].tolist()))
+    stats['quantiles'] = dict(zip(quantiles, np.quantile(values, quantiles).tolist() if len(values)
+                                  else [math.nan] * len(quantiles)))
+    stats['histogram'] = {'counts': [], 'edges': []}
+    if bins and len(values):
+        low, high = values.min(), values.max()
+        edges = np.geomspace(low, high, bins + 1) if low > 0 and high > low else bins
+        hist, edges = np.histogram(values, bins=edges)
+        stats['histogram'] = {'counts': hist.tolist(), 'edges': edges.tolist()}
+    return stats
+
+
 # %% [markdown]
 # #### Функции для работы с базой данных <a name='db_functions'/>
 # %% [markdown]
@@ -175,7 +354,7 @@ def _format_select(ctes: "list of CTEs", select: "SQL select") -> str:
     заданных соответственно первым и вторым параметрами
     Возвращает запрос в виде строки.
     """
-    query = ( "with " + ", ".join(ctes) + " " + select)
+    query = ( ("with " + ", ".join(ctes) + " " if ctes else "") + select).rstrip()
     if query[-1] != ';':
         query = query + ';'
     return query
@@ -193,20 +372,49 @@ def psql_query(cursor: "Database cursor", ctes: "list of CTEs",
     """
     query = _format_select(ctes, select)
     # print("*DBG* multiline_query will execute:\n" + query)
-    cursor.execute(query)
-    return cursor.fetchall()
+    with stage('psql_query') as record:
+        cursor.execute(query)
+        rows = cursor.fetchall()
+        if record is not None:
+            record['rows'], record['bytes'] = len(rows), _rows_bytes(rows)
+    return rows
 
-# %%
+# %% [markdown]
 # Выполнение большого запроса в базу так, чтобы не сожрать всю память.
-# Решение со [StackOverflow](https://stackoverflow.com/a/57015290)
-# SA: https://docs.python.org/3/library/itertools.html#itertools.chain,
-#     https://docs.python.org/3.5/library/functools.html#functools.partial
+# Обычный (клиентский) курсор psycopg2 при `execute` забирает в память клиента весь результат
+# запроса, и `fetchmany` уже ничего не экономит.  Поэтому здесь используется именованный
+# курсор на стороне сервера: строки приходят пачками по `itersize` штук по мере чтения.
+# Соединение работает в режиме autocommit, а в нём именованный курсор должен быть объявлен
+# `WITH HOLD` (иначе он закроется вместе с неявной транзакцией), и закрывать его нужно явно.
+# SA: https://www.psycopg.org/docs/usage.html#server-side-cursors
+# %%
+ITERSIZE = 10000
+_server_cursor_ids = count()
+
 def large_query(cursor: "DB Cursor", ctes: "list of CTEs", sql: "SQL query",
-               chunksize=1000) -> chain:
+                chunksize=ITERSIZE, params=None) -> "iterator of rows":
+    """
+    Запрос, результат которого читается потоком, пачками по chunksize строк.
+    Параметры: 1) курсор PsycoPg2 (используется его соединение), 2) список CTE,
+    3) запрос SQL, 4) размер пачки, 5) параметры запроса для psycopg2 (необязательно).
+    Возвращает: итератор по строкам результата (Named Tuple-ам).
+    """
     query = _format_select(ctes, sql)
-    cursor.execute(query)
-    chunks_until_empty = iter(partial(cursor.fetchmany, chunksize), [])
-    return chain.from_iterable(chunks_until_empty)
+    conn = cursor.connection
+    ss_cursor = conn.cursor(name=f"large_query_{next(_server_cursor_ids)}", withhold=conn.autocommit)
+    ss_cursor.itersize = chunksize
+    try:
+        with stage('large_query') as record:
+            ss_cursor.execute(query, params)
+            if record is None:
+                yield from ss_cursor
+            else:
+                for row in ss_cursor:
+                    record['rows'] += 1
+                    record['bytes'] += _rows_bytes((row,))
+                    yield row
+    finally:
+        ss_cursor.close()
 
 # %% [markdown]
 # | [К оглавлению](#contents) | [К началу раздела](#program)  |
@@ -229,6 +437,9 @@ def is_interactive() -> bool:
 # Инициализация графической подсистемы, только в интерактивном режиме
 # %%
 def init_graphics():
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from matplotlib.axes._axes import _log as matplotlib_axes_logger
     sns.set()
     matplotlib_axes_logger.setLevel('ERROR')  # disable color warnings in Matplotlib
     sns.set_style('whitegrid')
@@ -242,6 +453,7 @@ def init_graphics():
 def print_tops(ids_count, pairs_count):
     """Печатает верхние и нижние N курсов и пар. Параметры: 1) счётчик курсов, 2) счётчик пар.
        Количеством курсов в выдаче можно поиграть"""
+    from IPython.display import HTML, display
     TOP_COUNT = 5
     IDS_LEN   = TOP_COUNT*5 + (TOP_COUNT-1) * 3 + 2
     PAIRS_LEN = TOP_COUNT*10 + (TOP_COUNT-1) * 3 + 2
@@ -261,10 +473,13 @@ def print_tops(ids_count, pairs_count):
               "| " + " | ".join([ f"{_st2str(st):10s}" for (st, cnt) in pairs_top ]) + " |\n",
               "+" + PAIRS_LEN * "-" + "+\n")
 
-    _print_ids_top(f"Верхние {TOP_COUNT} самых покупаемых курсов",ids_count.most_common(TOP_COUNT))
-    _print_pairs_top(f"{TOP_COUNT} самых покупаемых пар курсов", pairs_count.most_common(TOP_COUNT))
-    _print_ids_top(f"Нижние {TOP_COUNT} самых НЕпопулярных курсов", ids_count.most_common()[-TOP_COUNT-1:-1])
-    _print_pairs_top(f"{TOP_COUNT} самых НЕпопулярных пар курсов", pairs_count.most_common()[-TOP_COUNT-1:-1])
+    # Верхние и нижние курсы и пары — без полной сортировки счётчиков, см. summary_stats
+    ids_stats = summary_stats(ids_count, TOP_COUNT, bins=0)
+    pairs_stats = summary_stats(pairs_count, TOP_COUNT, bins=0)
+    _print_ids_top(f"Верхние {TOP_COUNT} самых покупаемых курсов", ids_stats['top'])
+    _print_pairs_top(f"{TOP_COUNT} самых покупаемых пар курсов", pairs_stats['top'])
+    _print_ids_top(f"Нижние {TOP_COUNT} самых НЕпопулярных курсов", ids_stats['bottom'])
+    _print_pairs_top(f"{TOP_COUNT} самых НЕпопулярных пар курсов", pairs_stats['bottom'])
     display(HTML('''<a name="tops_by_popularity"/>'''))
     return
 
@@ -272,12 +487,15 @@ def print_tops(ids_count, pairs_count):
 # Наглядное представление (не)популярности курсов: построение количества проданных курсов
 # на координатной плоскости по убыванию.
 # %%
-def plot_top_courses(ids_count: 'Counter of course IDs and buy counts'):
+def plot_top_courses(ids_count: 'Series of courses by popularity or Counter of course IDs and buy counts'):
     """Строит график количества заказов на курсы, начиная с самых популярных.
-    Масштаб по оси Y логарифмический."""
-    pop_courses = pd.Series({id: cnt for id, cnt in ids_count.most_common()}) 
+    Масштаб по оси Y логарифмический.  Если передан уже упорядоченный Series, повторно не сортирует."""
+    import matplotlib.pyplot as plt
+    from IPython.display import HTML, display
+    pop_courses = ids_count if isinstance(ids_count, pd.Series) else freq_series(ids_count)
     fig = plt.figure(figsize=(12,7)) 
-    ax = pop_courses.plot(kind='bar')
+    ax = fig.gca()
+    ax.bar(np.arange(len(pop_courses)), pop_courses.to_numpy(), width=1.0)  # один вызов на все курсы
     ax.set_title("Популярность курсов, от самых популярных к малоизвестным")
     plt.yscale('log')
     plt.xticks([])
@@ -297,31 +515,77 @@ def plot_top_courses(ids_count: 'Counter of course IDs and buy counts'):
 # преобразовать её в [тепловую карту](#pairs_heatmap_a), её можно воспринимать.  Карта, конечно,
 # будет симметричной относительно диагонали, которая идёт от "частого" угла (левого
 # верхнего) в "редкий" (правый нижний).
+#
+# Карта рисуется одним растровым изображением (`imshow`), а не ячейка за ячейкой, поэтому годится и для
+# тысяч курсов.  Если курсов больше, чем `HEATMAP_MAX_PIXELS`, матрица сворачивается в блоки
+# (в блоке — максимум или сумма), так что изображение не больше, чем может показать экран.  Сворачиваются
+# только ненулевые элементы, разреженная матрица плотной не становится.  Ноль в логарифмическом
+# масштабе изобразить нельзя; раньше ради этого ко всей таблице прибавлялось 0.1, теперь нули просто
+# рисуются цветом минимума шкалы.
+#
+# Отрисованная карта сохраняется в PNG рядом со снимком данных и при следующем запуске показывается
+# из файла, пока снимок не изменится.
 # %%
-def show_heatmap_pairs(course_pairs_df: "2D matrix of pairs frequency"):
-    fig, (ax_norm, ax_log) = plt.subplots(1,2, figsize=(14,6))
-    fig.suptitle('Популярность пар курсов. По осям популярность уменьшается слева направо и сверху вниз')
-    # color_norm = mpl.colors.Normalize(0,400)
-    gn = sns.heatmap(course_pairs_df, annot=False,
-        norm=mpl.colors.Normalize(0,400),
-        linewidths=0.0,
-        cmap=sns.color_palette('OrRd', 400),
-        ax = ax_norm)
-    gn.set_title("Цвет в линейном масштабе")
-    gn.set_xticks([])
-    gn.set_yticks([])
-    # Поскольку в логарифмическом масштабе нельзя изобразить ноль,
-    # добавляю фиктивные 0.1 раза встречаемости во все пары.  Это влияет только
-    # на изображение.
-    gl = sns.heatmap(course_pairs_df+0.1, annot=False,
-        norm=mpl.colors.LogNorm(0.1,700),
-        linewidths=0.0,
-        cmap=sns.color_palette('OrRd', 400),
-        ax = ax_log)
-    gl.set_title("Цвет в логарифмическом масштабе")
-    gl.set_xticks([])
-    gl.set_yticks([])
-    plt.show()
+HEATMAP_MAX_PIXELS = 1000
+HEATMAP_LINEAR_MAX = 400  # в линейном масштабе цвет «насыщается» на этом числе пар
+
+def aggregate_blocks(matrix: "DataFrame, np.ndarray or scipy.sparse matrix", max_pixels=HEATMAP_MAX_PIXELS,
+                     how='max') -> (np.ndarray, int):
+    """Сворачивает матрицу в блоки factor×factor так, чтобы по каждой оси было не больше max_pixels точек.
+    how — 'max' или 'sum' (что ставить в блок).  Возвращает кортеж: изображение (float64) и factor"""
+    if how not in ('max', 'sum'):
+        raise ValueError(f"Unknown block aggregation '{how}', expected 'max' or 'sum'")
+    if isinstance(matrix, pd.DataFrame):
+        matrix = matrix.to_numpy()
+    n_rows, n_cols = matrix.shape
+    factor = max(1, math.ceil(max(n_rows, n_cols) / max_pixels))
+    values = sparse.coo_matrix(matrix)
+    image = np.zeros((math.ceil(n_rows / factor), math.ceil(n_cols / factor)), dtype=np.float64)
+    (np.maximum if how == 'max' else np.add).at(image, (values.row // factor, values.col // factor), values.data)
+    return image, factor
+
+def render_heatmap(matrix: "DataFrame, np.ndarray or scipy.sparse matrix", max_pixels=HEATMAP_MAX_PIXELS,
+                   how='max') -> "matplotlib Figure":
+    "Рисует тепловую карту пар курсов в линейном и логарифмическом масштабе, возвращает Figure"
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    image, factor = aggregate_blocks(matrix, max_pixels, how)
+    cmap = mpl.colormaps['OrRd'].copy()
+    cmap.set_bad(cmap(0.0))  # нули (и пустые блоки) в логарифмическом масштабе
+    fig, (ax_norm, ax_log) = plt.subplots(1, 2, figsize=(14, 6))
+    suptitle = 'Популярность пар курсов. По осям популярность уменьшается слева направо и сверху вниз'
+    if factor > 1:
+        suptitle += f"\nблоки {factor}×{factor} курсов, в блоке {'максимум' if how == 'max' else 'сумма'}"
+    fig.suptitle(suptitle)
+    for (ax, norm, title) in ((ax_norm, mpl.colors.Normalize(0, HEATMAP_LINEAR_MAX), "Цвет в линейном масштабе"),
+                              (ax_log, mpl.colors.LogNorm(1, max(image.max(), 1)), "Цвет в логарифмическом масштабе")):
+        ax.imshow(image, norm=norm, cmap=cmap, interpolation='nearest', aspect='auto')
+        ax.set_title(title)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.grid(False)
+    return fig
+
+def heatmap_cache_path(snapshot_file: str, max_pixels=HEATMAP_MAX_PIXELS, how='max') -> str:
+    "Файл, в котором хранится отрисованная по снимку тепловая карта"
+    return f"{snapshot_file}.heatmap-{max_pixels}-{how}.png"
+
+def show_heatmap_pairs(course_pairs: "2D matrix of pairs frequency", snapshot_file=None,
+                       max_pixels=HEATMAP_MAX_PIXELS, how='max'):
+    """Показывает тепловую карту пар курсов. Параметры: 1) матрица пар (DataFrame, массив или разреженная),
+    2) файл снимка, из которого взята матрица (для кеша картинки), 3-4) см. aggregate_blocks"""
+    import matplotlib.pyplot as plt
+    from IPython.display import HTML, Image, display
+    cache = None
+    if snapshot_file and os.path.exists(snapshot_file):
+        cache = heatmap_cache_path(snapshot_file, max_pixels, how)
+    if cache and os.path.exists(cache) and os.stat(cache).st_mtime >= os.stat(snapshot_file).st_mtime:
+        display(Image(filename=cache))
+    else:
+        fig = render_heatmap(course_pairs, max_pixels, how)
+        if cache:
+            fig.savefig(cache)
+        plt.show()
     display(HTML('<a name="pairs_heatmap_a"/>'))
     return
 
@@ -333,6 +597,7 @@ def show_heatmap_pairs(course_pairs_df: "2D matrix of pairs frequency"):
 # [Посмотрим в цифрах](#tb_corners) «частый» (левый верхний) угол и «редкий» (правый нижний) углы матрицы
 # %%
 def print_top_bottom_corners(course_pairs_df: "2D matrix of course pairs frequency"):
+    from IPython.display import HTML, display
     TOP_ANGLE_COUNT=20
     display(HTML('<a name="tb_corners"/>'))
     print(f"Пары для {TOP_ANGLE_COUNT} самых часто покупаемых курсов")
@@ -358,11 +623,14 @@ def print_top_bottom_corners(course_pairs_df: "2D matrix of course pairs frequen
 # 
 # Каждому пользователю ставится в соответствие купленный
 # им курс. Если курсов больше одного, в выводе будет несколько
-# записей с одним `user_id`
+# записей с одним `user_id`.  Сортировка здесь не нужна: все запросы дальше
+# группируют строки сами.
+#
+# Для параллельного подсчёта пар этот же CTE можно ограничить частью пользователей (шардом):
+# в шаблон подставляется дополнительное условие на `user_id`.
 
 # %%
-USER_COURSE_PAIRS = """\
-user_course_pairs as (
+USER_COURSE_PAIRS_SELECT = """\
     select user_id, resource_id as course_id
     from
         final.carts as c
@@ -371,9 +639,15 @@ user_course_pairs as (
     where
         i.resource_type = 'Course'
         and
-        c.state = 'successful'
-    order by user_id
-)"""
+        c.state = 'successful'{user_filter}
+"""
+USER_COURSE_PAIRS_TEMPLATE = "user_course_pairs as (\n" + USER_COURSE_PAIRS_SELECT + ")"
+USER_COURSE_PAIRS = USER_COURSE_PAIRS_TEMPLATE.format(user_filter="")
+
+def sharded_user_course_pairs(shard: int, shards: int) -> str:
+    "CTE user_course_pairs только для пользователей шарда: user_id % shards = shard"
+    return USER_COURSE_PAIRS_TEMPLATE.format(
+        user_filter=f"\n        and\n        c.user_id % {int(shards)} = {int(shard)}")
 
 # %% [markdown]
 # Сколько клиентов покупали курсы?
@@ -448,6 +722,75 @@ group by user_id
 having count(distinct course_id) > 1;
 """
 
+# %% [markdown]
+# Пары курсов можно посчитать и прямо в базе: самосоединение списка «пользователь — курс» по
+# `user_id` даёт все пары курсов одного пользователя, а `group by` их считает.  Условие
+# `a.course_id < b.course_id` оставляет каждую пару один раз и отбрасывает пары курса с самим собой.
+# Пользователи с одним курсом пар не образуют, так что результат совпадает с подсчётом в Python
+# по `COURSES_LIST_QUERY`, но по сети передаётся только около N_курсов² строк вместо строки на каждого покупателя.
+
+# %%
+DISTINCT_USER_COURSES = """\
+distinct_user_courses as (
+    select distinct user_id, course_id
+    from user_course_pairs
+)"""
+
+PAIRS_COUNT_QUERY = """\
+select a.course_id as course_a, b.course_id as course_b, count(*) as pairs_cnt
+from
+    distinct_user_courses as a
+    join distinct_user_courses as b
+    on a.user_id = b.user_id and a.course_id < b.course_id
+group by a.course_id, b.course_id;
+"""
+
+# %% [markdown]
+# Все запросы за данными строятся на одном и том же отношении `user_course_pairs` — соединении
+# `final.carts` и `final.cart_items`.  Обычно это CTE, и база заново вычисляет соединение в каждом
+# запросе, причём между запросами данные могут успеть измениться.  В режиме «единого снимка»
+# соединение вычисляется один раз: во временную таблицу `user_course_pairs` с индексами, внутри одной
+# транзакции REPEATABLE READ.  Все проверки и выборки в этой транзакции видят одни и те же данные,
+# а CTE в запросы не добавляется (иначе оно скрыло бы временную таблицу).
+#
+# Создать временную таблицу в транзакции «только для чтения» нельзя, поэтому транзакция начинается
+# в режиме чтения-записи и сразу после создания таблицы переключается в «только чтение».
+# По окончании работы транзакция откатывается, временная таблица удаляется вместе с ней.
+# Параллельный подсчёт пар (`workers > 1`) в этом режиме запрещён: процессы работают в своих
+# соединениях и не видят ни временной таблицы, ни снимка.
+# %%
+MATERIALIZE_USER_COURSE_PAIRS = (
+    "create temporary table user_course_pairs on commit drop as\n"
+    + USER_COURSE_PAIRS_SELECT.format(user_filter="") + """;
+create index on user_course_pairs (user_id);
+create index on user_course_pairs (course_id);
+analyze user_course_pairs;
+set transaction read only;""")
+
+_materialized_connections = set()  # соединения, в которых user_course_pairs — временная таблица
+
+@contextmanager
+def materialized_snapshot(cursor):
+    """Контекстный менеджер: всё, что выполняется внутри, работает с одним снимком данных
+    и временной таблицей user_course_pairs. Параметры: 1) курсор PsycoPg2"""
+    conn = cursor.connection
+    conn.set_session(isolation_level='REPEATABLE READ', readonly=False, autocommit=False)
+    try:
+        cursor.execute(MATERIALIZE_USER_COURSE_PAIRS)
+        _materialized_connections.add(conn)
+        yield cursor
+    finally:
+        _materialized_connections.discard(conn)
+        conn.rollback()
+        conn.set_session(isolation_level='DEFAULT', readonly=True, autocommit=True)
+
+def base_ctes(cursor, *ctes, base=None) -> list:
+    """Список CTE для запроса к user_course_pairs: базовое отношение (если оно не материализовано
+    в этом соединении) и затем переданные CTE. Параметр base заменяет стандартный CTE user_course_pairs"""
+    if base is None:
+        base = None if cursor.connection in _materialized_connections else USER_COURSE_PAIRS
+    return ([base] if base else []) + list(ctes)
+
 # %% [markdown]
 # | [К оглавлению](#contents) | [К началу раздела](#program)  |
 # |:---|---:|
@@ -464,10 +807,10 @@ def check_ctes(cursor):
     запросы, совпадают с ожидаемыми.  Работает только для данных 2017-2018 годов, для других данных
     нужно переделать или отключить.
     Параметры: 1) Курсор PgSQL"""
-    bought_courses_cnt =  psql_query(cursor, [USER_COURSE_PAIRS, COURSES_BOUGHT], 'select count(course_id) from courses_bought')[0][0]
-    bought_courseids_lst = psql_query(cursor, [USER_COURSE_PAIRS, COURSES_BOUGHT], 'select course_id from courses_bought')
+    bought_courses_cnt =  psql_query(cursor, base_ctes(cursor, COURSES_BOUGHT), 'select count(course_id) from courses_bought')[0][0]
+    bought_courseids_lst = psql_query(cursor, base_ctes(cursor, COURSES_BOUGHT), 'select course_id from courses_bought')
 
-    assert(psql_query(cursor, [USER_COURSE_PAIRS, BUYERS_COUNT], "select * from buyers_count")[0][0] == 49006)
+    assert(psql_query(cursor, base_ctes(cursor, BUYERS_COUNT), "select * from buyers_count")[0][0] == 49006)
     assert(psql_query(cursor, [COURSES_IN_CARTS], 'select * from courses_count')[0][0] == 127)
     assert(bought_courses_cnt == 126)
     assert(len(bought_courseids_lst) == 126)
@@ -477,44 +820,524 @@ def check_ctes(cursor):
 # Запрос в базу: список курсов и число приобретений этих курсов клиентами
 # по убыванию популярности.  Курсов немного, всю информацию получаю в один запрос.
 # %%
-def get_cids_by_popularity(cursor: "PsycpPg2 database cursor") -> Counter:
+def get_cids_by_popularity(cursor: "PsycpPg2 database cursor or LocalSource") -> Counter:
+    if isinstance(cursor, LocalSource):
+        return cursor.ids_count()
     ids_count = Counter()
-    for id, cnt in psql_query(cursor, [USER_COURSE_PAIRS, TIMES_BOUGHT_BY_COURSE],
+    for id, cnt in psql_query(cursor, base_ctes(cursor, TIMES_BOUGHT_BY_COURSE),
                                 """select * from times_bought_by_resid;"""):
         ids_count[id] = cnt
     return ids_count
 
+# %% [markdown]
+# Счётчик пар.  `Counter` с ключами `frozenset` тратит на каждую пару больше 200 байт (объект множества,
+# два числа, запись в хеш-таблице), и по нему ничего нельзя посчитать векторно.  Поэтому векторные движки
+# возвращают `PairCounts`: ID курсов по возрастанию, а пара — целый код `min_idx * N + max_idx` по
+# номерам курсов в этом списке; коды (по возрастанию) и количества лежат в двух массивах NumPy, т.е.
+# 12–16 байт на пару.  Интерфейс тот же, что у `Counter`: `most_common`, `pairs_count[frozenset((a, b))]`,
+# `in`, `len`, перебор пар в виде `frozenset` — поэтому функции печати и построения матрицы работают
+# с обоими видами счётчиков.  Для векторной работы есть `pairs()` (массивы ID пар) и `lookup`.
+# %%
+class PairCounts(Mapping):
+    """Счётчик пар курсов на массивах NumPy.  Пара хранится кодом min_idx * N + max_idx, где
+    min_idx < max_idx — номера курсов в course_ids (ID по возрастанию), N = len(course_ids)"""
+    def __init__(self, course_ids: np.ndarray, codes: np.ndarray, counts: np.ndarray):
+        self.course_ids, self.codes, self.counts = course_ids, codes, counts
+
+    @classmethod
+    def from_id_pairs(cls, first, second, counts) -> 'PairCounts':
+        "Счётчик по массивам ID курсов пары и количеств (порядок курсов в паре любой, повторы пар складываются)"
+        first, second = np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64)
+        counts = np.asarray(counts)
+        course_ids = np.unique(np.concatenate([first, second]))
+        first, second = np.searchsorted(course_ids, first), np.searchsorted(course_ids, second)
+        codes, inverse = np.unique(np.minimum(first, second) * len(course_ids) + np.maximum(first, second),
+                                   return_inverse=True)
+        summed = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(codes))
+        return cls(course_ids, codes, summed if counts.dtype.kind == 'f' else summed.astype(np.int64))
+
+    @classmethod
+    def from_counter(cls, counter: Mapping) -> 'PairCounts':
+        "Счётчик по словарю {frozenset(пара_курсов): количество}"
+        if isinstance(counter, PairCounts):
+            return counter
+        n_pairs = len(counter)
+        pairs = np.fromiter(chain.from_iterable(counter.keys()), dtype=np.int64, count=2*n_pairs).reshape(n_pairs, 2)
+        dtype = np.float64 if any(isinstance(v, float) for v in counter.values()) else np.int64
+        return cls.from_id_pairs(pairs[:, 0], pairs[:, 1], np.fromiter(counter.values(), dtype=dtype, count=n_pairs))
+
+    @classmethod
+    def sum(cls, parts: "iterable of PairCounts or Counter") -> 'PairCounts':
+        "Сумма нескольких счётчиков пар"
+        parts = [cls.from_counter(part) for part in parts]
+        if not parts:
+            return cls.from_id_pairs([], [], np.empty(0, dtype=np.int64))
+        firsts, seconds = zip(*(part.pairs() for part in parts))
+        return cls.from_id_pairs(np.concatenate(firsts), np.concatenate(seconds),
+                                 np.concatenate([part.counts for part in parts]))
+
+    def pairs(self) -> (np.ndarray, np.ndarray):
+        "Массивы ID курсов пар (первый ID меньше второго), в порядке кодов"
+        n_courses = len(self.course_ids)
+        return self.course_ids[self.codes // n_courses], self.course_ids[self.codes % n_courses]
+
+    def lookup(self, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+        "Количества для массивов пар (first[i], second[i]); для отсутствующих пар — 0"
+        n_courses = len(self.course_ids)
+        first, second = np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64)
+        result = np.zeros(len(first), dtype=self.counts.dtype)
+        if not n_courses or not len(self.codes):
+            return result
+        idx_a = np.searchsorted(self.course_ids, first).clip(max=n_courses - 1)
+        idx_b = np.searchsorted(self.course_ids, second).clip(max=n_courses - 1)
+        known = (self.course_ids[idx_a] == first) & (self.course_ids[idx_b] == second) & (first != second)
+        codes = np.minimum(idx_a, idx_b) * n_courses + np.maximum(idx_a, idx_b)
+        pos = np.searchsorted(self.codes, codes).clip(max=len(self.codes) - 1)
+        found = known & (self.codes[pos] == codes)
+        result[found] = self.counts[pos[found]]
+        return result
+
+    def __getitem__(self, pair) -> int:
+        "Количество для пары (frozenset или кортеж из двух ID); для отсутствующей пары, как у Counter, — 0"
+        (first, second) = tuple(pair)
+        return self.lookup([first], [second])[0].item()
+
+    def __contains__(self, pair) -> bool:
+        return len(pair) == 2 and self[pair] != 0
+
+    def get(self, pair, default=None):
+        return self[pair] if pair in self else default
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __iter__(self):
+        return map(frozenset, zip(*(ids.tolist() for ids in self.pairs())))
+
+    def items(self) -> list:
+        return list(zip(self, self.counts.tolist()))
+
+    def values(self) -> list:
+        return self.counts.tolist()
+
+    def most_common(self, n=None) -> list:
+        "Пары по убыванию количества (как Counter.most_common), при равенстве — по возрастанию ID"
+        order = np.argsort(-self.counts, kind='stable')[:n]
+        first, second = self.pairs()
+        return [(frozenset(pair), cnt) for (*pair, cnt) in
+                zip(first[order].tolist(), second[order].tolist(), self.counts[order].tolist())]
+
+    def to_counter(self) -> Counter:
+        "Обычный Counter с ключами frozenset (для кода, которому нужен именно он)"
+        return Counter(dict(self.items()))
+
+    @property
+    def nbytes(self) -> int:
+        return self.course_ids.nbytes + self.codes.nbytes + self.counts.nbytes
+
+    def __eq__(self, other) -> bool:
+        "Сравнение с другим счётчиком пар; пары с нулевым количеством, как у Counter, не учитываются"
+        if not isinstance(other, Mapping):
+            return NotImplemented
+        arrays = []
+        for counter in (self, PairCounts.from_counter(other)):
+            nonzero = counter.counts != 0
+            first, second = counter.pairs()
+            arrays.append((first[nonzero], second[nonzero], counter.counts[nonzero]))
+        return all(np.array_equal(mine, theirs) for (mine, theirs) in zip(*arrays))
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return f"PairCounts({len(self)} pairs, {self.nbytes} bytes)"
+
 # %% [markdown]
 # Функция, которая получает список курсов, купленных каждым клиентом, из базы.
 # Интересен случай, когда пользователь покупал одни и те же курсы больше одного раза.
 # Решаем эту проблему как в SQL c помощью `distinct`, так и здесь — использованием `set`.
+#
+# Данные читаются потоком, и пары каждого пользователя сразу добавляются в счётчик, ничего
+# не сохраняя про самого пользователя: в памяти одновременно находится только одна пачка строк
+# из базы и сам счётчик пар.
 # %%
-def get_ids_pairs_counts_from_db(cursor) -> (Counter, Counter):
-    """Функция делает запрос в базу и возвращает два счётчика в кортеже:
-    1) Счётчик встречаемости курсов (по ID) среди покупателей, которые приобрели 2 и более курсов.
-    2) Счётчик встречаемости пар курсов (каждой паре поставлено в соответствие кол-во её вхождений
-    в покупках пользователей.  Группировка по пользователям, так что курсы, купленные в разных
-    корзинах одним пользователем, окажутся в паре)"""
-    user_count=0
-    users_data_d = {}  # {uid: { {course, course}, {course, course}, ... } }
-    all_courses = set()
+def count_pairs_from_lists(courses_lists: "iterable of course ID collections") -> Counter:
+    "Подсчёт пар по спискам курсов покупателей (один список на покупателя, повторы в списке допустимы)"
     pairs_count = Counter()
-    ids_count = Counter()
-
-    for (users_count, (user_id, courses_cnt, user_courses_str)) in enumerate(
-        large_query(cursor, [USER_COURSE_PAIRS], COURSES_LIST_QUERY)
-        ):
-        s_courses = set( [int(i) for i in user_courses_str.split()] )  # default split on whitespace
-        assert(len(s_courses) == courses_cnt)
-        # increase counters for individual courses
-        # for course_id in s_courses:
-        #     ids_count[course_id] += 1
-        l_pairs = combinations(s_courses, 2)
-        users_data_d[user_id] = set([frozenset(t) for t in l_pairs])
-        for pair in users_data_d[user_id]:
-            pairs_count[pair] += 1
+    for courses in courses_lists:
+        pairs_count.update(map(frozenset, combinations(set(courses), 2)))
     return pairs_count
 
+def _pairs_count_python(cursor, itersize, base_cte=None) -> Counter:
+    "Подсчёт пар в Python: из базы приходят списки курсов каждого покупателя"
+    def _users_courses():
+        for (user_id, courses_cnt, user_courses_str) in large_query(cursor, base_ctes(cursor, base=base_cte),
+                                                                     COURSES_LIST_QUERY, itersize):
+            s_courses = set( [int(i) for i in user_courses_str.split()] )  # default split on whitespace
+            assert(len(s_courses) == courses_cnt)
+            yield s_courses
+    return count_pairs_from_lists(_users_courses())
+
+# %% [markdown]
+# Второй способ — [подсчёт пар в базе](#const_cte), из базы приходят уже готовые пары с количеством.
+# %%
+def _pairs_count_sql(cursor, itersize, base_cte=None) -> PairCounts:
+    "Подсчёт пар в базе данных, из базы приходят тройки (курс, курс, количество)"
+    rows = large_query(cursor, base_ctes(cursor, DISTINCT_USER_COURSES, base=base_cte), PAIRS_COUNT_QUERY, itersize)
+    triples = np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, 3)
+    return PairCounts.from_id_pairs(triples[:, 0], triples[:, 1], triples[:, 2])
+
+# %% [markdown]
+# Третий способ — без текстовых строк вообще.  `STRING_AGG` заставляет базу печатать числа
+# в текст, а Python — разбирать их обратно, и на этом уходит заметная часть времени.  Вместо этого
+# пары «пользователь — курс» выгружаются командой `COPY ... TO STDOUT` в двоичном формате
+# ([описание формата](https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4)):
+# каждая строка — это число полей (int16) и для каждого поля длина (int32) и значение.  Оба поля
+# приводятся к `int4`, так что все строки одинаковой длины (18 байт) и декодируются в массивы NumPy
+# одним `np.frombuffer`.  `copy_expert` передаёт поток по одному сообщению на строку, поэтому
+# декодер сначала копит байты и разбирает их кусками по `COPY_DECODE_BYTES`, а не на каждый вызов.
+#
+# Дальше пары считаются векторно: строки сортируются по пользователю и курсу, повторы удаляются,
+# и для каждого сдвига d = 1, 2, ... берутся пары (курс[i], курс[i+d]) там, где у строк i и i+d
+# один и тот же пользователь.  На каждом шаге остаются только те i, у которых группа ещё не
+# закончилась, поэтому шагов столько, сколько курсов у самого «жадного» покупателя, а работа
+# пропорциональна числу пар.
+
+# %%
+USER_COURSE_ROWS_QUERY = """\
+select user_id::int4, course_id::int4
+from user_course_pairs
+where user_id is not null and course_id is not null
+"""
+
+PGCOPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_DECODE_BYTES = 4 * 2 ** 20  # сколько накопить в буфере, прежде чем декодировать
+
+def pgcopy_int4_row(n_fields: int) -> np.dtype:
+    "Тип NumPy для строки потока COPY в двоичном формате из n_fields полей int4"
+    return np.dtype([('fields', '>i2')] + [(name, '>i4') for i in range(n_fields)
+                                           for name in (f'len_{i}', f'value_{i}')])
+
+class _CopyBinaryDecoder:
+    """Файлоподобный объект для cursor.copy_expert: принимает поток COPY в двоичном формате
+    и декодирует строки из n_fields полей int4 (по умолчанию двух) в массивы NumPy"""
+    def __init__(self, n_fields=2):
+        self._buffer = bytearray()
+        self._header_done = False
+        self._row = pgcopy_int4_row(n_fields)
+        self._columns = [[] for _ in range(n_fields)]
+        self.bytes_read = 0
+
+    def write(self, data):
+        # copy_expert вызывает write на каждое сообщение CopyData, а Postgres шлёт по сообщению на строку,
+        # так что здесь данные только копятся, а декодируются крупными кусками
+        self.bytes_read += len(data)
+        self._buffer += data
+        if len(self._buffer) >= COPY_DECODE_BYTES:
+            self._decode()
+        return len(data)
+
+    def _decode(self):
+        "Декодирует все целые строки из буфера"
+        if not self._header_done:
+            if len(self._buffer) < len(PGCOPY_SIGNATURE) + 8:
+                return
+            assert(self._buffer.startswith(PGCOPY_SIGNATURE))
+            ext_len = int.from_bytes(self._buffer[len(PGCOPY_SIGNATURE) + 4:len(PGCOPY_SIGNATURE) + 8], 'big')
+            header_len = len(PGCOPY_SIGNATURE) + 8 + ext_len
+            if len(self._buffer) < header_len:
+                return
+            del self._buffer[:header_len]
+            self._header_done = True
+        # Признак конца потока (2 байта) короче строки, так что целой строкой он не окажется
+        n_rows = len(self._buffer) // self._row.itemsize
+        if n_rows:
+            rows = np.frombuffer(self._buffer, dtype=self._row, count=n_rows)
+            assert((rows['fields'] == len(self._columns)).all())
+            for (i, column) in enumerate(self._columns):
+                assert((rows[f'len_{i}'] == 4).all())  # NULL пришёл бы с длиной -1
+                column.append(rows[f'value_{i}'].astype(np.int32))
+            del rows  # представление держит буфер, пока оно живо, его нельзя укоротить
+            del self._buffer[:n_rows * self._row.itemsize]
+        return
+
+    def arrays(self) -> tuple:
+        "Возвращает декодированные массивы, по одному на поле (например, user_id и course_id)"
+        self._decode()
+        assert(self._buffer == b'\xff\xff')  # в буфере остался только признак конца потока
+        return tuple(np.concatenate(column or [np.empty(0, np.int32)]) for column in self._columns)
+
+def copy_user_courses(cursor, base_cte=None) -> (np.ndarray, np.ndarray):
+    """Выгружает пары «пользователь — курс» командой COPY в двоичном формате.
+    Возвращает два массива одинаковой длины: user_id и course_id"""
+    return _copy_int4_columns(cursor, _format_select(base_ctes(cursor, base=base_cte), USER_COURSE_ROWS_QUERY))
+
+def _copy_int4_columns(cursor, query: str, n_fields=2) -> tuple:
+    """Выполняет запрос, возвращающий n_fields колонок int4, через COPY в двоичном формате.
+    Возвращает кортеж массивов, по одному на колонку; порядок строк сохраняется"""
+    query = query.strip().rstrip(';')
+    decoder = _CopyBinaryDecoder(n_fields)
+    with stage('copy') as record:
+        cursor.copy_expert(f"copy ({query}) to stdout with (format binary)", decoder)
+        columns = decoder.arrays()
+        if record is not None:
+            record['rows'], record['bytes'] = len(columns[0]), decoder.bytes_read
+    return columns
+
+# %%
+def _sorted_user_courses(users: np.ndarray, courses: np.ndarray) -> (np.ndarray, np.ndarray):
+    "Сортирует пары «пользователь — курс» по пользователю и курсу и удаляет повторы"
+    order = np.lexsort((courses, users))
+    users, courses = users[order], courses[order]
+    unique = np.ones(len(users), dtype=bool)
+    unique[1:] = (users[1:] != users[:-1]) | (courses[1:] != courses[:-1])
+    return users[unique], courses[unique].astype(np.int64)
+
+def _pair_codes(users: np.ndarray, courses: np.ndarray, base: int):
+    """Генератор кодов пар курсов (меньший_ID * base + больший_ID), по массиву на каждый сдвиг.
+    Массивы должны быть подготовлены _sorted_user_courses"""
+    starts = np.arange(len(users))
+    shift = 1
+    while True:
+        starts = starts[starts + shift < len(users)]
+        starts = starts[users[starts + shift] == users[starts]]
+        if not len(starts):
+            return
+        # курсы внутри пользователя отсортированы, так что courses[i] < courses[i + shift]
+        yield courses[starts] * base + courses[starts + shift]
+        shift += 1
+
+def count_pairs_from_arrays(users: np.ndarray, courses: np.ndarray) -> PairCounts:
+    """Векторный подсчёт пар курсов по массивам user_id и course_id (повторы допустимы).
+    Возвращает счётчик пар PairCounts (пара -> число пользователей)"""
+    users, courses = _sorted_user_courses(users, courses)
+    base = int(courses.max(initial=0)) + 1
+    codes, counts = [], []
+    for shift_codes in _pair_codes(users, courses, base):
+        shift_codes, shift_counts = np.unique(shift_codes, return_counts=True)
+        codes.append(shift_codes)
+        counts.append(shift_counts)
+    if not codes:
+        return PairCounts.from_id_pairs([], [], np.empty(0, dtype=np.int64))
+    codes = np.concatenate(codes)
+    return PairCounts.from_id_pairs(codes // base, codes % base, np.concatenate(counts))
+
+def _pairs_count_copy(cursor, itersize, base_cte=None) -> PairCounts:
+    "Подсчёт пар по двоичной выгрузке COPY, itersize не используется"
+    return count_pairs_from_arrays(*copy_user_courses(cursor, base_cte))
+
+# %% [markdown]
+# Четвёртый способ — линейная алгебра.  Из тех же массивов строится разреженная двоичная матрица
+# $X$ «пользователь × курс» (единица, если пользователь купил курс), и вся матрица сочетаний получается
+# одним произведением $X^T X$: на пересечении строки $a$ и столбца $b$ — число пользователей, купивших
+# оба курса, а на диагонали — число покупателей курса, т.е. заодно и популярность курсов (`ids_count`).
+# Произведение разреженных матриц считается скомпилированным кодом `scipy.sparse`.
+# %%
+def user_course_matrix(users: np.ndarray, courses: np.ndarray) -> (sparse.csr_matrix, np.ndarray):
+    """Двоичная разреженная матрица «пользователь × курс» по массивам user_id и course_id (повторы допустимы).
+    Возвращает кортеж: CSR матрица и массив ID курсов, соответствующих столбцам (по возрастанию)"""
+    user_rows = np.unique(users, return_inverse=True)[1].reshape(-1)
+    course_ids, course_cols = np.unique(courses, return_inverse=True)
+    matrix = sparse.csr_matrix((np.ones(len(user_rows), dtype=np.int32), (user_rows, course_cols.reshape(-1))),
+                               shape=(int(user_rows.max(initial=-1)) + 1, len(course_ids)))
+    matrix.data[:] = 1  # повторные покупки одного курса при построении сложились
+    return matrix, course_ids
+
+def cooccurrence_from_arrays(users: np.ndarray, courses: np.ndarray) -> (sparse.csr_matrix, pd.Index):
+    """Матрица сочетаний курсов X^T X по массивам user_id и course_id.
+    Возвращает кортеж: CSR матрица (на диагонали — число покупателей курса) и pd.Index с ID курсов"""
+    matrix, course_ids = user_course_matrix(users, courses)
+    return (matrix.T @ matrix).tocsr(), pd.Index(course_ids.astype(np.int64))
+
+def counts_from_cooccurrence(matrix: sparse.csr_matrix, course_ids: pd.Index) -> (Counter, PairCounts):
+    """Счётчики популярности курсов (диагональ, по убыванию, при равенстве — по возрастанию ID)
+    и пар курсов (вне диагонали) из матрицы сочетаний X^T X"""
+    buyers = matrix.diagonal()
+    order = np.lexsort((course_ids.to_numpy(), -buyers))
+    ids_count = Counter(dict(zip(course_ids[order].tolist(), buyers[order].tolist())))
+    return ids_count, pairs_count_from_matrix(matrix, course_ids)
+
+def _pairs_count_sparse(cursor, itersize, base_cte=None) -> PairCounts:
+    "Подсчёт пар произведением X^T X по двоичной выгрузке COPY, itersize не используется"
+    return counts_from_cooccurrence(*cooccurrence_from_arrays(*copy_user_courses(cursor, base_cte)))[1]
+
+# %% [markdown]
+# Приближённый подсчёт для очень больших каталогов.  Точный счётчик пар растёт как квадрат числа
+# курсов (запись `Counter` с ключом `frozenset` — больше 200 байт), а для рекомендаций нужны лишь
+# K самых частых партнёров каждого курса.  Поэтому пары курсов считаются в скетче Count-Min:
+# таблица `depth` × `width` счётчиков, пара прибавляется в одну ячейку каждой строки (своя хеш-функция
+# на строку), оценка — минимум по строкам.  Оценка никогда не меньше точного значения и с вероятностью
+# не ниже $1 - e^{-depth}$ превышает его не больше чем на $e / width$ от общего числа пар.
+#
+# Кроме скетча для каждого курса хранятся `candidates` партнёров с наибольшей оценкой (идея
+# алгоритма Space-Saving).  Данные обрабатываются пачками пользователей: пары пачки добавляются
+# в скетч, затем к кандидатам добавляются пары пачки, и у каждого курса остаются лучшие `candidates`
+# по текущим оценкам.  В конце кандидаты оцениваются по полному скетчу и выдаются обычным счётчиком
+# пар, так что дальше всё работает как с точным подсчётом.  Память: скетч
+# (`width · depth · 4` байта) плюс не больше `2 · candidates` пар на курс.  Скетч один на весь
+# подсчёт, поэтому движок работает в одном процессе: сумма оценок из скетчей отдельных шардов
+# уже не гарантирует ни оценки сверху, ни границы ошибки.
+# %%
+SKETCH_WIDTH = 2 ** 20
+SKETCH_DEPTH = 4
+SKETCH_CANDIDATES = 20
+SKETCH_BATCH_ROWS = 1_000_000  # строк «пользователь — курс» в пачке
+
+class CountMinSketch:
+    "Скетч Count-Min для целочисленных ключей (кодов пар курсов)"
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, seed=0):
+        self.bits = max(int(width - 1).bit_length(), 1)  # ширина округляется вверх до степени двойки
+        self.table = np.zeros((depth, 2 ** self.bits), dtype=np.uint32)
+        rng = np.random.default_rng(seed)
+        self._mult = rng.integers(1, 2 ** 63, depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._add = rng.integers(0, 2 ** 63, depth, dtype=np.uint64)
+        self.total = 0
+
+    def _hashes(self, keys: np.ndarray) -> np.ndarray:
+        "Хеши multiply-shift: массив depth × len(keys) номеров ячеек"
+        keys = keys.astype(np.uint64)[None, :]
+        return (keys * self._mult[:, None] + self._add[:, None]) >> np.uint64(64 - self.bits)
+
+    def add(self, keys: np.ndarray, counts: np.ndarray):
+        "Прибавляет counts к ключам keys"
+        for row, cells in zip(self.table, self._hashes(keys)):
+            np.add.at(row, cells, counts.astype(np.uint32))
+        self.total += int(counts.sum())
+        return
+
+    def estimate(self, keys: np.ndarray) -> np.ndarray:
+        "Оценки (сверху) для ключей keys"
+        cells = self._hashes(keys)
+        return np.take_along_axis(self.table, cells.astype(np.intp), axis=1).min(axis=0)
+
+    def error_bound(self) -> float:
+        "Граница ошибки оценки (с вероятностью 1 - e^-depth)"
+        return math.e / self.table.shape[1] * self.total
+
+def _top_partner_codes(codes: np.ndarray, estimates: np.ndarray, base: int, candidates: int) -> np.ndarray:
+    "Оставляет коды пар, которые входят в лучшие candidates партнёров хотя бы одного из двух курсов"
+    rows = np.concatenate([codes // base, codes % base])
+    codes, estimates = np.concatenate([codes, codes]), np.concatenate([estimates, estimates])
+    order = np.lexsort((codes, -estimates.astype(np.int64), rows))
+    rows = rows[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    return np.unique(codes[order][rank < candidates])
+
+def approx_pairs_count(users: np.ndarray, courses: np.ndarray, width=SKETCH_WIDTH, depth=SKETCH_DEPTH,
+                       candidates=SKETCH_CANDIDATES, batch_rows=SKETCH_BATCH_ROWS) -> PairCounts:
+    """Приближённый подсчёт пар курсов по массивам user_id и course_id.
+    Параметры: массивы, ширина и глубина скетча, число кандидатов в партнёры на курс, строк в пачке.
+    Возвращает счётчик PairCounts (пара -> оценка) только для пар-кандидатов"""
+    users, courses = _sorted_user_courses(users, courses)
+    base = int(courses.max(initial=0)) + 1
+    sketch = CountMinSketch(width, depth)
+    kept = np.empty(0, dtype=np.int64)
+    # Пачки режутся по границам пользователей: пары образуются только внутри пользователя
+    user_starts = np.concatenate([[0], np.flatnonzero(np.diff(users)) + 1])
+    positions = np.arange(0, len(users), batch_rows)
+    cuts = np.unique(np.append(user_starts[np.searchsorted(user_starts, positions, side='right') - 1], len(users)))
+    for (lo, hi) in zip(cuts[:-1], cuts[1:]):
+        batch = list(_pair_codes(users[lo:hi], courses[lo:hi], base))
+        if not batch:
+            continue
+        codes, counts = np.unique(np.concatenate(batch), return_counts=True)
+        sketch.add(codes, counts)
+        codes = np.union1d(kept, codes)
+        kept = _top_partner_codes(codes, sketch.estimate(codes), base, candidates)
+    return PairCounts.from_id_pairs(kept // base, kept % base, sketch.estimate(kept).astype(np.int64))
+
+def _pairs_count_approx(cursor, itersize, base_cte=None, **options) -> PairCounts:
+    "Приближённый подсчёт пар по двоичной выгрузке COPY, itersize не используется"
+    return approx_pairs_count(*copy_user_courses(cursor, base_cte), **options)
+
+# %% [markdown]
+# Отчёт о точности приближённого подсчёта по сравнению с точным: доля настоящих K лучших партнёров,
+# найденных приближённо (recall), доля курсов с полностью совпавшим списком, завышение оценок.
+# Считается на тестовых данных, см. `final_proj_benchmark.py`.
+# %%
+def approx_accuracy(exact: PairCounts, approx: PairCounts, course_ids: "pd.Index of course IDs", k: int) -> dict:
+    "Сравнивает K лучших партнёров по точному и приближённому счётчикам пар, возвращает словарь с метриками"
+    exact_cols, _ = top_k_partners(make_pairs_matrix(exact, course_ids), k)
+    approx_cols, _ = top_k_partners(make_pairs_matrix(approx, course_ids), k)
+    valid = exact_cols >= 0
+    found = (approx_cols[:, :, None] == exact_cols[:, None, :]).any(axis=1) & valid
+    exact, approx = PairCounts.from_counter(exact), PairCounts.from_counter(approx)
+    overestimate = approx.counts / exact.lookup(*approx.pairs()) - 1
+    return {'pairs_exact': len(exact), 'pairs_kept': len(approx),
+            'topk_recall': round(float(found.sum() / max(valid.sum(), 1)), 4),
+            'rows_identical': round(float((approx_cols == exact_cols).all(axis=1).mean()), 4),
+            'mean_overestimate': round(float(overestimate.mean() if len(overestimate) else 0), 4),
+            'max_overestimate': round(float(overestimate.max(initial=0)), 4)}
+
+# %% [markdown]
+# Способ подсчёта («движок») выбирается по имени.  По умолчанию пары считает база, подсчёт
+# в Python оставлен как запасной вариант.
+#
+# Движок `sparse` в однопроцессном режиме заодно выдаёт популярность курсов (см. [загрузку данных](#load_data)),
+# отдельный запрос для неё не нужен.
+#
+# Подсчёт можно распараллелить: пользователи делятся на `workers` шардов по остатку `user_id % workers`,
+# каждый процесс открывает своё соединение с базой, считает пары своего шарда тем же движком,
+# а частичные счётчики в конце складываются.  Пары образуются только внутри одного пользователя,
+# поэтому сумма по шардам совпадает с подсчётом по всем пользователям сразу.
+# %%
+PAIRS_ENGINES = {
+    'sql': _pairs_count_sql,
+    'python': _pairs_count_python,
+    'copy': _pairs_count_copy,
+    'sparse': _pairs_count_sparse,
+    'approx': _pairs_count_approx,
+}
+APPROX_ENGINES = {'approx'}  # результат приближённый, в сверке движков не участвует
+PAIRS_ENGINE = 'sql'
+PAIRS_WORKERS = 1
+
+def _pairs_count_shard(task: tuple) -> Counter:
+    """Подсчёт пар одного шарда в отдельном процессе.
+    Параметр: кортеж (строка подключения, движок, шард, всего шардов, itersize, параметры движка)"""
+    (conn_string, engine, shard, shards, itersize, options) = task
+    cursor = init_connect(conn_string)
+    try:
+        return PAIRS_ENGINES[engine](cursor, itersize, sharded_user_course_pairs(shard, shards), **options)
+    finally:
+        cursor.connection.close()
+
+def get_ids_pairs_counts_from_db(cursor, itersize=ITERSIZE, engine=PAIRS_ENGINE,
+                                 workers=PAIRS_WORKERS, conn_string=None, engine_options=None) -> Mapping:
+    """Функция делает запрос в базу и возвращает счётчик встречаемости пар курсов (каждой паре
+    поставлено в соответствие кол-во её вхождений в покупках пользователей.  Группировка по
+    пользователям, так что курсы, купленные в разных корзинах одним пользователем, окажутся в паре).
+    Параметры: 1) курсор PsycoPg2, 2) сколько строк читать из базы за один раз,
+    3) имя движка подсчёта из PAIRS_ENGINES, 4) количество параллельных процессов,
+    5) строка подключения для процессов (по умолчанию DB_CONNECT_STRING),
+    6) словарь дополнительных параметров движка (например, размеры скетча для 'approx').
+    Вместо курсора можно передать локальный источник данных (LocalSource)."""
+    options = engine_options or {}
+    if isinstance(cursor, LocalSource):
+        if engine in APPROX_ENGINES:
+            return approx_pairs_count(*cursor.user_course_arrays(), **options)
+        return cursor.pairs_count()
+    if engine not in PAIRS_ENGINES:
+        raise ValueError(f"Unknown pairs engine '{engine}', expected one of: {', '.join(PAIRS_ENGINES)}")
+    if workers <= 1:
+        return PAIRS_ENGINES[engine](cursor, itersize, **options)
+    if engine in APPROX_ENGINES:
+        # Сумма оценок из отдельных скетчей шардов не сохраняет гарантий скетча, а памяти нужно в workers раз больше
+        raise ValueError(f"Pairs engine '{engine}' works in one process, use workers=1")
+    tasks = [(conn_string or DB_CONNECT_STRING, engine, shard, workers, itersize, options) for shard in range(workers)]
+    with multiprocessing.Pool(workers) as pool:
+        return PairCounts.sum(pool.imap_unordered(_pairs_count_shard, tasks))
+
+# %% [markdown]
+# Проверка, что все движки подсчёта пар дают одинаковый результат. Запросы тяжёлые,
+# поэтому в обычном запуске проверка не выполняется.
+# %%
+def check_pairs_engines(cursor) -> bool:
+    "Сравнивает счётчики пар, полученные всеми точными движками. Параметры: 1) Курсор PgSQL"
+    counters = [get_ids_pairs_counts_from_db(cursor, engine=engine) for engine in PAIRS_ENGINES
+                if engine not in APPROX_ENGINES]
+    for counter in counters[1:]:
+        assert(counter == counters[0])
+    return True
 
 # %% [markdown]
 # Занятно, что в списке возможных комбинаций мы получаем
@@ -529,6 +1352,338 @@ def get_ids_pairs_counts_from_db(cursor) -> (Counter, Counter):
 # | [К оглавлению](#contents) | [К началу раздела](#program)  |
 # |:---|---:|
 
+# %% [markdown]
+# #### Локальные источники данных <a name='local_sources'/>
+# %% [markdown]
+# Весь расчёт можно выполнить и без Postgres — по выгрузке таблиц `carts` и `cart_items` в файлы
+# (Parquet или CSV) или по встроенной базе SQLite.  Это удобно для работы с сохранёнными срезами данных
+# и для CI, и не нагружает рабочую базу тяжёлой аналитикой.
+#
+# Локальный источник загружает отношение `user_course_pairs` целиком в два массива NumPy (user_id и
+# course_id), а популярность курсов и пары считаются по ним векторно.  Объект источника можно передать
+# в `get_cids_by_popularity` и `get_ids_pairs_counts_from_db` вместо курсора базы (движок подсчёта
+# пар в этом случае не выбирается: пары всегда считаются по массивам).
+#
+# Для файлов соединение таблиц делается в NumPy: корзины сортируются по ID, и для каждой позиции
+# корзины её покупатель и статус находятся бинарным поиском.  В SQLite файл базы подключается под
+# именем `final`, так что работает тот же запрос, что и в Postgres.
+
+# %%
+CARTS_COLUMNS = ['id', 'user_id', 'state']
+CART_ITEMS_COLUMNS = ['cart_id', 'resource_type', 'resource_id']
+
+def user_course_arrays(carts: pd.DataFrame, cart_items: pd.DataFrame) -> (np.ndarray, np.ndarray):
+    """Аналог CTE user_course_pairs для таблиц в памяти.
+    Параметры: DataFrame-ы с колонками CARTS_COLUMNS и CART_ITEMS_COLUMNS.
+    Возвращает массивы user_id и course_id купленных курсов"""
+    order = np.argsort(carts['id'].to_numpy(), kind='stable')
+    cart_ids = carts['id'].to_numpy()[order]
+    cart_users = carts['user_id'].to_numpy()[order]
+    cart_ok = (carts['state'] == 'successful').to_numpy()[order]
+    item_carts = cart_items['cart_id'].to_numpy()
+    pos = np.minimum(np.searchsorted(cart_ids, item_carts), max(len(cart_ids) - 1, 0))
+    bought = ((cart_items['resource_type'] == 'Course').to_numpy()
+              & (cart_ids[pos] == item_carts) & cart_ok[pos])
+    return cart_users[pos[bought]], cart_items['resource_id'].to_numpy()[bought]
+
+def count_buyers_from_arrays(users: np.ndarray, courses: np.ndarray) -> Counter:
+    """Счётчик популярности курсов (число разных покупателей) по массивам user_id и course_id,
+    по убыванию популярности, при равенстве — по возрастанию ID курса"""
+    pairs = np.unique(np.stack([courses.astype(np.int64), users.astype(np.int64)]), axis=1)
+    course_ids, buyers = np.unique(pairs[0], return_counts=True)
+    order = np.lexsort((course_ids, -buyers))
+    return Counter(dict(zip(course_ids[order].tolist(), buyers[order].tolist())))
+
+class LocalSource(ABC):
+    """Источник данных без Postgres. Наследники определяют _load(), возвращающий массивы (user_id, course_id),
+    и fingerprint()"""
+    def __init__(self):
+        self._arrays = None
+
+    def user_course_arrays(self) -> (np.ndarray, np.ndarray):
+        if self._arrays is None:
+            with stage('local_load') as record:
+                self._arrays = self._load()
+                if record is not None:
+                    record['rows'] = len(self._arrays[0])
+        return self._arrays
+
+    def ids_count(self) -> Counter:
+        return count_buyers_from_arrays(*self.user_course_arrays())
+
+    def pairs_count(self) -> PairCounts:
+        return count_pairs_from_arrays(*self.user_course_arrays())
+
+    def sequence_arrays(self) -> (np.ndarray, np.ndarray):
+        "Массивы (user_id, course_id) в порядке покупки, см. course_sequence_arrays"
+        raise ValueError(f"{type(self).__name__} has no purchase times, use SQLite or the database for sequences")
+
+    @abstractmethod
+    def fingerprint(self) -> list:
+        "Дешёвый отпечаток исходных данных для кэша результатов (см. source_fingerprint)"
+
+    @abstractmethod
+    def _load(self) -> (np.ndarray, np.ndarray):
+        "Загружает массивы (user_id, course_id) купленных курсов"
+
+class FileSource(LocalSource):
+    "Выгрузка таблиц carts и cart_items в файлы Parquet (.parquet) или CSV (.csv, в т.ч. сжатые)"
+    def __init__(self, carts_path: str, cart_items_path: str):
+        super().__init__()
+        self.carts_path, self.cart_items_path = carts_path, cart_items_path
+
+    @staticmethod
+    def _read(path: str, columns: list) -> pd.DataFrame:
+        if path.endswith('.parquet'):
+            return pd.read_parquet(path, columns=columns)
+        return pd.read_csv(path, usecols=columns)
+
+    def _load(self) -> (np.ndarray, np.ndarray):
+        return user_course_arrays(self._read(self.carts_path, CARTS_COLUMNS),
+                                  self._read(self.cart_items_path, CART_ITEMS_COLUMNS))
+
+    def fingerprint(self) -> list:
+        return [file_fingerprint(self.carts_path), file_fingerprint(self.cart_items_path)]
+
+class SQLiteSource(LocalSource):
+    "База SQLite с таблицами carts и cart_items"
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+    def _load(self) -> (np.ndarray, np.ndarray):
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute("attach database ? as final", (self.path,))
+            frame = pd.read_sql_query(USER_COURSE_PAIRS_SELECT.format(user_filter=""), conn)
+        finally:
+            conn.close()
+        return frame['user_id'].to_numpy(), frame['course_id'].to_numpy()
+
+    def sequence_arrays(self) -> (np.ndarray, np.ndarray):
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute("attach database ? as final", (self.path,))
+            frame = pd.read_sql_query(COURSE_SEQUENCE_QUERY, conn)
+        finally:
+            conn.close()
+        return frame['user_id'].to_numpy(), frame['course_id'].to_numpy()
+
+    def fingerprint(self) -> list:
+        return [file_fingerprint(self.path)]
+
+def file_fingerprint(path: str) -> list:
+    "Отпечаток файла: абсолютный путь, размер и время изменения (в наносекундах)"
+    info = os.stat(path)
+    return [os.path.abspath(path), info.st_size, info.st_mtime_ns]
+
+def open_local_source(carts=None, cart_items=None, sqlite=None) -> LocalSource:
+    "Создаёт локальный источник данных по путям к файлам; если пути не заданы — None"
+    if sqlite:
+        return SQLiteSource(sqlite)
+    if carts or cart_items:
+        if not (carts and cart_items):
+            raise ValueError("Both carts and cart_items files are required")
+        return FileSource(carts, cart_items)
+    return None
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
+
+# %% [markdown]
+# #### Инкрементальное обновление данных <a name='incremental'/>
+# %% [markdown]
+# Полный пересчёт по всем успешным корзинам с начала времён долог, а за сутки (или час) меняется
+# лишь малая часть данных.  Поэтому между запусками можно хранить состояние:
+#
+# - «водяной знак» (watermark) — время покупки и ID последней учтённой корзины;
+# - множество купленных курсов для каждого покупателя (включая тех, кто купил один курс);
+# - счётчик популярности курсов и счётчик пар.
+#
+# При следующем запуске из базы читаются только корзины, ставшие успешными после водяного знака.
+# Новый курс покупателя образует пары и с другими новыми курсами, и со всеми курсами, купленными
+# им раньше, поэтому результат совпадает с полным пересчётом.  Время покупки берётся из `purchased_at`,
+# а если его нет — из `updated_at` корзины.  Сравнение идёт по паре (время, ID корзины), чтобы
+# не потерять корзины с одинаковым временем покупки.
+#
+# Транзакции фиксируются не в порядке времени покупки: корзина с более ранним временем может появиться
+# в базе уже после того, как водяной знак ушёл дальше.  Поэтому корзины читаются с запасом
+# `WATERMARK_OVERLAP` до водяного знака.  Повторно прочитанные покупки ничего не меняют: курс, уже
+# записанный в множество покупателя, второй раз не учитывается.
+#
+# Состояние хранится в файле формата pickle. Файл записывается во временный и затем переименовывается,
+# так что прерванный запуск не испортит сохранённое состояние.
+#
+# Кроме счётчиков «за всё время» состояние может вести взвешенные по времени счётчики (ключ `weighted`):
+#
+# - затухание (`half_life`, дни): покупка курса и пара курсов учитываются с весом $2^{-\Delta t / T_{1/2}}$,
+#   где $\Delta t$ — возраст покупки (для пары — возраст более поздней из двух покупок);
+# - окно (`window`, дни): учитываются только покупки и пары последних `window` дней.
+#
+# Возраст отсчитывается от времени последней учтённой покупки (водяного знака), а не от текущего
+# времени, так что результат зависит только от данных.  При обновлении старые счётчики не пересчитываются
+# по истории: при затухании они умножаются на общий множитель за прошедшее время, в режиме окна
+# хранятся счётчики по дням, и дни, вышедшие из окна, вычитаются из итоговых.  Затем добавляются веса
+# новых покупок.  Взвешенные счётчики при затухании дробные, в режиме окна — целые.
+#
+# Общий множитель затухания не применяется к каждой записи счётчика (при миллионах пар это цикл
+# в Python на каждом обновлении), а хранится отдельно (`scale`): в счётчиках лежат веса, делённые
+# на него.  Новая покупка добавляется с весом, делённым на `scale`, а настоящие веса получаются
+# одним векторным умножением, когда счётчики нужны для расчёта (`weighted_counts`).  Чтобы значения
+# не росли без предела, множитель изредка (когда он меньше `WEIGHT_SCALE_MIN`) переносится в счётчики.
+
+# %%
+NEW_PURCHASES_QUERY = """\
+select
+    coalesce(c.purchased_at, c.updated_at) as purchased_at,
+    c.id as cart_id,
+    c.user_id,
+    i.resource_id as course_id
+from
+    final.carts as c
+    join final.cart_items as i
+    on c.id = i.cart_id
+where
+    i.resource_type = 'Course'
+    and
+    c.state = 'successful'
+    and
+    (coalesce(c.purchased_at, c.updated_at), c.id) > (%(purchased_at)s, %(cart_id)s)
+"""
+
+DAY_SECONDS = 24 * 3600
+WEIGHT_SCALE_MIN = 2.0 ** -64
+WATERMARK_OVERLAP = timedelta(minutes=15)  # запас на корзины, зафиксированные позже более новых
+
+def new_incremental_state(half_life=None, window=None) -> dict:
+    """Пустое состояние для инкрементального обновления, с него начинается самый первый запуск.
+    Параметры (необязательные, не больше одного): период полураспада или ширина окна в днях
+    для взвешенных по времени счётчиков"""
+    if half_life and window:
+        raise ValueError("Time decay and sliding window are mutually exclusive")
+    weighted = None
+    if half_life or window:
+        weighted = {'half_life': half_life, 'window': window,
+                    'time': None,          # момент, на который посчитаны веса
+                    'scale': 1.0,          # общий множитель затухания: вес = значение счётчика · scale
+                    'buckets': {},         # {день: (Counter курсов, Counter пар)} — только для окна
+                    'ids_count': Counter(),
+                    'pairs_count': Counter()}
+    return {'watermark': None,    # (purchased_at, cart_id) последней учтённой корзины
+            'user_courses': {},   # {user_id: {course_id, ...}}
+            'ids_count': Counter(),
+            'pairs_count': Counter(),
+            'weighted': weighted}
+
+def load_incremental_state(path: str, half_life=None, window=None) -> dict:
+    """Загружает сохранённое состояние из файла. Если файла нет, возвращает пустое состояние
+    с заданным взвешиванием по времени (см. new_incremental_state)"""
+    if not os.path.exists(path):
+        return new_incremental_state(half_life, window)
+    with open(path, 'rb') as state_file:
+        state = pickle.load(state_file)
+    weighted = state.get('weighted') or {}
+    if (weighted.get('half_life'), weighted.get('window')) != (half_life or None, window or None):
+        raise ValueError(f"State file {path} was built with different time weighting, remove it to recount")
+    return state
+
+def save_incremental_state(state: dict, path: str):
+    "Сохраняет состояние в файл (через временный файл и переименование)"
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as state_file:
+        pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    return
+
+# %%
+def _advance_weighted_counts(weighted: dict, now):
+    "Переносит взвешенные счётчики на момент now: затухание — общим множителем scale, окно — вычитанием старых дней"
+    if weighted['half_life']:
+        if weighted['time'] is not None:
+            age = (now - weighted['time']).total_seconds() / DAY_SECONDS
+            weighted['scale'] = weighted.get('scale', 1.0) * 0.5 ** (age / weighted['half_life'])
+            if weighted['scale'] < WEIGHT_SCALE_MIN:
+                for counter in (weighted['ids_count'], weighted['pairs_count']):
+                    for key in counter:
+                        counter[key] *= weighted['scale']
+                weighted['scale'] = 1.0
+    else:
+        first_day = now.toordinal() - weighted['window'] + 1
+        for day in [day for day in weighted['buckets'] if day < first_day]:
+            ids_count, pairs_count = weighted['buckets'].pop(day)
+            weighted['ids_count'] -= ids_count
+            weighted['pairs_count'] -= pairs_count
+    weighted['time'] = now
+    return
+
+def _add_weighted_purchase(weighted: dict, bought, course_id, pairs: list):
+    "Добавляет во взвешенные счётчики покупку курса во время bought и образованные ей пары"
+    if weighted['half_life']:
+        age = (weighted['time'] - bought).total_seconds() / DAY_SECONDS
+        weight = 0.5 ** (age / weighted['half_life']) / weighted.get('scale', 1.0)
+        counters = [(weighted['ids_count'], weighted['pairs_count'])]
+    else:
+        day = bought.toordinal()
+        if day <= weighted['time'].toordinal() - weighted['window']:
+            return
+        weight = 1
+        counters = [(weighted['ids_count'], weighted['pairs_count']),
+                    weighted['buckets'].setdefault(day, (Counter(), Counter()))]
+    for (ids_count, pairs_count) in counters:
+        ids_count[course_id] += weight
+        for pair in pairs:
+            pairs_count[pair] += weight
+    return
+
+def weighted_counts(weighted: dict) -> (Counter, Mapping):
+    "Взвешенные счётчики популярности и пар с применённым множителем затухания"
+    scale = weighted.get('scale', 1.0)
+    if not weighted['half_life'] or scale == 1.0:
+        return weighted['ids_count'], weighted['pairs_count']
+    pairs = PairCounts.from_counter(weighted['pairs_count'])
+    return (Counter({course_id: value * scale for (course_id, value) in weighted['ids_count'].items()}),
+            PairCounts(pairs.course_ids, pairs.codes, pairs.counts * scale))
+
+# %%
+def update_incremental_state(cursor, state: dict, itersize=ITERSIZE) -> dict:
+    """Дополняет состояние корзинами, ставшими успешными после водяного знака (с запасом WATERMARK_OVERLAP).
+    Параметры: 1) курсор PsycoPg2, 2) состояние (меняется на месте), 3) сколько строк читать за раз.
+    Возвращает: то же состояние с новым водяным знаком"""
+    watermark = state['watermark']
+    (purchased_at, cart_id) = (watermark[0] - WATERMARK_OVERLAP, 0) if watermark else ('-infinity', 0)
+    new_courses = {}  # {user_id: {course_id: время покупки}} — только новые покупки
+    for row in large_query(cursor, [], NEW_PURCHASES_QUERY, itersize,
+                           {'purchased_at': purchased_at, 'cart_id': cart_id}):
+        courses = new_courses.setdefault(row.user_id, {})
+        if row.course_id not in courses or row.purchased_at < courses[row.course_id]:
+            courses[row.course_id] = row.purchased_at
+        if watermark is None or (row.purchased_at, row.cart_id) > watermark:
+            watermark = (row.purchased_at, row.cart_id)
+
+    weighted = state.get('weighted')
+    if weighted is not None and watermark is not None:
+        _advance_weighted_counts(weighted, watermark[0])
+    user_courses, ids_count, pairs_count = state['user_courses'], state['ids_count'], state['pairs_count']
+    for (user_id, courses) in new_courses.items():
+        old_courses = user_courses.setdefault(user_id, set())
+        # В порядке покупки: каждый новый курс образует пары со всеми купленными до него
+        for (course_id, bought) in sorted(courses.items(), key=lambda item: item[1]):
+            if course_id in old_courses:
+                continue
+            pairs = [frozenset((course_id, old)) for old in old_courses]
+            ids_count[course_id] += 1
+            pairs_count.update(pairs)
+            if weighted is not None:
+                _add_weighted_purchase(weighted, bought, course_id, pairs)
+            old_courses.add(course_id)
+    state['watermark'] = watermark
+    return state
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
+
 # %% [markdown]
 # #### Построение матрицы сочетаний курсов <a name='matrix_create'/>
 
@@ -541,31 +1696,202 @@ def get_ids_pairs_counts_from_db(cursor) -> (Counter, Counter):
 # Нам понадобится какая-то точка отсчёта для «непопулярных» или, другими словами, редко встречающихся
 # курсов. В качестве такой точки возьму 5% квантиль популярности курса.
 # %%
+UNPOPULAR_QUANTILE = 0.05
+
 def get_unpopular_threshold(freq_table) -> int:
     "Выдаёт порог количества покупок, ниже которого курс считается непопулярным"
     # print('*DBG* Low popularity threshold:', math.ceil(freq_table.quantile(0.05)))
-    return math.ceil(freq_table.quantile(0.05))
+    stats = summary_stats(freq_table, n=0, quantiles=(UNPOPULAR_QUANTILE,), bins=0)
+    return math.ceil(stats['quantiles'][UNPOPULAR_QUANTILE])
 
 # %% [markdown]
 # Функция для построения двумерной матрицы из таблицы частоты встречаемости пар курсов
 #
 # Имеем: таблицу pairs_count, где каждой паре поставлена в соответсвие её частота встречаемости.
-# Строю: таблицу, где ID курсов по вертикали и горизонтали (их не так много). Делаю по обеим осям
+# Строю: таблицу, где ID курсов по вертикали и горизонтали. Делаю по обеим осям
 # сортировку по частоте курсов: логично предположить, что те курсы, которые покупаются чаще всего,
 # будут образовывать и наиболее часто встрачающиеся пары.
+#
+# Курсов становится всё больше (от 127 до тысяч), поэтому матрица строится не поэлементной записью
+# в DataFrame, а так: каждому ID курса один раз ставится в соответствие плотный индекс (номер строки
+# и столбца, в порядке `freq_table`), после чего все счётчики пар одной операцией раскладываются
+# в симметричную разреженную матрицу `scipy.sparse`.  DataFrame с подписями строится из неё же —
+# он нужен функциям визуализации.
+
+# %%
+def counts_dtype(counter: "Counter or PairCounts") -> np.dtype:
+    "Тип для значений счётчика: целые числа покупок или дробные веса (затухание по времени)"
+    if isinstance(counter, PairCounts):
+        return np.dtype(np.float64 if counter.counts.dtype.kind == 'f' else np.uint32)
+    return np.dtype(np.float64 if any(isinstance(v, float) for v in counter.values()) else np.uint32)
+
+def make_pairs_matrix(pairs_count_dict: "Dictionary with pair as a key and count as a value",
+                      course_ids: "pd.Index of course IDs") -> sparse.csr_matrix:
+    """
+    Построение симметричной разреженной матрицы сочетаний курсов. Параметры:
+        1) Счётчик пар: PairCounts или Counter вида {frozenset(пара_курсов): число_встреченных}
+        2) pd.Index с ID курсов; позиция ID в индексе — номер строки и столбца матрицы.
+    Пары, в которых есть курс, отсутствующий в индексе, пропускаются.
+    Возвращает: scipy.sparse.csr_matrix размером N×N, N = len(course_ids), типа uint32
+    (float64 для взвешенных по времени счётчиков).
+    """
+    n_courses = len(course_ids)
+    dtype = counts_dtype(pairs_count_dict)
+    pairs_count = PairCounts.from_counter(pairs_count_dict)
+    (first, second), counts = pairs_count.pairs(), pairs_count.counts.astype(dtype)
+    rows = course_ids.get_indexer(first)
+    cols = course_ids.get_indexer(second)
+    known = (rows >= 0) & (cols >= 0)
+    rows, cols, counts = rows[known], cols[known], counts[known]
+    matrix = sparse.coo_matrix((np.concatenate([counts, counts]),
+                                (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+                               shape=(n_courses, n_courses), dtype=dtype)
+    return matrix.tocsr()
 
 # %%
-def make_freq_matrix(pairs_count_dict: "Dictionary with pair as a key and count as a value") -> pd.DataFrame:
+def make_freq_matrix(pairs_count_dict: "Dictionary with pair as a key and count as a value",
+                     freq_courses: "Series of courses by popularity") -> pd.DataFrame:
     """
     Построение двумерной матрицы сочетаний курсов. Параметры:
-        1) Словарь, где каждому  ID курса соответствует Counter вида {(пара_курсов): число_встреченных}
+        1) Счётчик пар: PairCounts или Counter вида {frozenset(пара_курсов): число_встреченных}
+        2) Series, в которой собраны курсы по порядку убывания популярности.
+    Возвращает: pd.DataFrame с ID курсов по обеим осям.
     """
-    pairs_df = pd.DataFrame(index=freq_table.index, columns=freq_table.index, dtype=np.uint32, data=0)
-    for course_pair in pairs_count_dict.keys():
-        (course_1, course_2) = course_pair
-        pairs_df.loc[course_1, course_2] = pairs_count_dict[course_pair]
-        pairs_df.loc[course_2, course_1] = pairs_count_dict[course_pair]
-    return pairs_df
+    return matrix_to_frame(make_pairs_matrix(pairs_count_dict, freq_courses.index), freq_courses.index)
+
+def matrix_to_frame(matrix: sparse.spmatrix, course_ids: "pd.Index of course IDs") -> pd.DataFrame:
+    "Плотный DataFrame с подписями из разреженной матрицы пар курсов"
+    return pd.DataFrame(matrix.toarray(), index=course_ids, columns=course_ids)
+
+# %% [markdown]
+# #### Снимок данных <a name='snapshot'/>
+# %% [markdown]
+# Чтобы показать таблицы и графики, не нужно каждый раз ходить в базу: популярность курсов, матрицу
+# пар и соответствие «индекс — ID курса» можно сохранить в файл `.npz` (несжатый архив массивов NumPy)
+# и потом загрузить за миллисекунды.  Матрица хранится в разреженном виде (массивы `data`, `indices`,
+# `indptr` формата CSR), курсы — в порядке убывания популярности, как в `freq_table`.
+# %%
+SNAPSHOT_VERSION = 1
+
+def save_snapshot(path: str, ids_count: Counter, pairs_count: Counter):
+    """Сохраняет снимок данных в файл .npz. Параметры: 1) путь к файлу,
+    2) счётчик популярности курсов, 3) счётчик пар курсов"""
+    course_ids, counts = zip(*ids_count.most_common()) if ids_count else ((), ())
+    course_ids = pd.Index(np.array(course_ids, dtype=np.int64))
+    matrix = make_pairs_matrix(pairs_count, course_ids)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, version=SNAPSHOT_VERSION, course_ids=course_ids.to_numpy(),
+             ids_count=np.array(counts, dtype=np.int64 if counts_dtype(ids_count).kind == 'u' else np.float64),
+             shape=np.array(matrix.shape),
+             data=matrix.data, indices=matrix.indices, indptr=matrix.indptr)
+    os.replace(tmp_path, path)
+    return
+
+def load_snapshot(path: str) -> (Counter, sparse.csr_matrix, pd.Index):
+    """Загружает снимок данных из файла .npz.
+    Возвращает кортеж: 1) счётчик популярности курсов, 2) разреженная матрица пар,
+    3) pd.Index с ID курсов (строки и столбцы матрицы)"""
+    with np.load(path) as snapshot:
+        assert(int(snapshot['version']) == SNAPSHOT_VERSION)
+        course_ids = pd.Index(snapshot['course_ids'])
+        ids_count = Counter(dict(zip(course_ids.tolist(), snapshot['ids_count'].tolist())))
+        matrix = sparse.csr_matrix((snapshot['data'], snapshot['indices'], snapshot['indptr']),
+                                   shape=tuple(snapshot['shape']))
+    return ids_count, matrix, course_ids
+
+# %% [markdown]
+# Обратное преобразование: счётчик пар из матрицы (для функций, которые печатают пары).
+# %%
+def pairs_count_from_matrix(matrix: sparse.spmatrix, course_ids: "pd.Index of course IDs") -> PairCounts:
+    "Строит счётчик пар PairCounts по верхнему треугольнику матрицы пар"
+    upper = sparse.triu(matrix, k=1, format='coo')
+    ids = course_ids.to_numpy()
+    data = upper.data.astype(np.float64 if upper.data.dtype.kind == 'f' else np.int64)
+    return PairCounts.from_id_pairs(ids[upper.row], ids[upper.col], data)
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
+
+# %% [markdown]
+# #### Последовательности покупок <a name='sequences'/>
+# %% [markdown]
+# Пары курсов не учитывают порядок покупок, а последний запрос в `SQL/users.sql` показывает, что
+# последовательности покупок у пользователей есть.  Отсюда второй вариант рекомендаций — «следующий курс»:
+# матрица переходов первого порядка, в которой на пересечении строки A и столбца B — число пользователей,
+# купивших курс B сразу после курса A.
+#
+# Покупки каждого пользователя выгружаются одним запросом, упорядоченными по времени покупки (как
+# в инкрементальном режиме: `purchased_at`, а если его нет, `updated_at` корзины) и времени добавления
+# курса в корзину.  Повторная покупка курса не учитывается: остаётся первое вхождение.  Дальше всё
+# векторно: соседние строки одного пользователя дают переходы, которые одной операцией складываются
+# в разреженную матрицу.  Таблица «следующих курсов» строится из неё тем же `recommend_top_k`
+# и выдаётся так же, как основная (`build --sequences`).
+# %%
+COURSE_SEQUENCE_QUERY = """select cast(c.user_id as integer) as user_id, cast(i.resource_id as integer) as course_id
+from
+    final.carts as c
+    join final.cart_items as i
+    on c.id = i.cart_id
+where
+    i.resource_type = 'Course'
+    and
+    c.state = 'successful'
+    and
+    c.user_id is not null
+order by c.user_id, coalesce(c.purchased_at, c.updated_at), i.updated_at, i.id
+"""
+
+def course_sequence_arrays(cursor: "PsycoPg2 cursor or LocalSource") -> (np.ndarray, np.ndarray):
+    """Покупки курсов в порядке покупки у каждого пользователя.
+    Возвращает массивы user_id и course_id (строки одного пользователя идут подряд)"""
+    if isinstance(cursor, LocalSource):
+        return cursor.sequence_arrays()
+    return _copy_int4_columns(cursor, COURSE_SEQUENCE_QUERY)
+
+def make_transition_matrix(users: np.ndarray, courses: np.ndarray,
+                           course_ids: "pd.Index of course IDs") -> sparse.csr_matrix:
+    """Матрица переходов «курс A -> следующий купленный курс B» по покупкам в порядке покупки.
+    Параметры: массивы user_id и course_id (внутри пользователя — в порядке покупки), pd.Index с ID курсов
+    (строки и столбцы матрицы).  Возвращает разреженную CSR матрицу N×N типа uint32"""
+    order = np.argsort(users, kind='stable')  # порядок покупок внутри пользователя сохраняется
+    users, courses = users[order].astype(np.int64), courses[order].astype(np.int64)
+    base = int(courses.max(initial=0)) + 1
+    first = np.zeros(len(users), dtype=bool)
+    first[np.unique(users * base + courses, return_index=True)[1]] = True
+    users, courses = users[first], courses[first]
+    same_user = users[1:] == users[:-1]
+    rows = course_ids.get_indexer(courses[:-1][same_user])
+    cols = course_ids.get_indexer(courses[1:][same_user])
+    known = (rows >= 0) & (cols >= 0)
+    n_courses = len(course_ids)
+    return sparse.csr_matrix((np.ones(int(known.sum()), dtype=np.uint32), (rows[known], cols[known])),
+                             shape=(n_courses, n_courses), dtype=np.uint32)
+
+def load_transitions(source=None) -> (pd.Series, sparse.csr_matrix):
+    """Загружает последовательности покупок из базы (или локального источника) и строит матрицу переходов.
+    Возвращает кортеж: Series популярности курсов и матрица переходов в том же порядке курсов"""
+    if source is not None:
+        with stage('sequences'):
+            users, courses = course_sequence_arrays(source)
+    else:
+        with stage('connect'):
+            cursor = init_connect(DB_CONNECT_STRING)
+        try:
+            with stage('sequences'):
+                users, courses = course_sequence_arrays(cursor)
+        finally:
+            cursor.connection.close()
+    freq_courses = freq_series(count_buyers_from_arrays(users, courses))
+    with stage('transitions') as record:
+        matrix = make_transition_matrix(users, courses, freq_courses.index)
+        if record is not None:
+            record['rows'] = len(users)
+    return freq_courses, matrix
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
 
 # %% [markdown]
 # #### Построение таблицы рекомендаций <a name='recommendations'/>
@@ -579,42 +1905,363 @@ def make_freq_matrix(pairs_count_dict: "Dictionary with pair as a key and count
 # 3. второй по встречаемости в паре с курсом из первой колонки курс.
 #
 # Если частота хотя бы одного из курсов пары меньше критической, этот курс
-# заменяется в рекомендации на самый популярный.  Не знаю, насколько такая замена
+# заменяется в рекомендации на самый популярный из тех, которых ещё нет в строке (и не сам курс,
+# к которому выдаются рекомендации).  Не знаю, насколько такая замена
 # оправдана, на мой взгляд, система тегов помогла бы выдавать более осмысленные
 # рекомендации.
 
+# %% [markdown]
+# Количество рекомендаций на курс.  По заданию их две, но движок умеет выдавать любое количество K:
+# первые две колонки называются как раньше (`first_rec`, `second_rec`), следующие — `rec_3`, `rec_4` и т.д.
+# %%
+RECS_COUNT = 2
+REC_COLUMNS = ['first_rec', 'second_rec']
+
+def rec_columns(k: int) -> list:
+    "Имена колонок таблицы рекомендаций для K рекомендаций на курс"
+    return (REC_COLUMNS + [f"rec_{i}" for i in range(len(REC_COLUMNS) + 1, k + 1)])[:k]
+
+# %% [markdown]
+# Выбор K самых частых партнёров сразу для всех строк матрицы.  Вместо полной сортировки каждой
+# строки используется частичный выбор (`np.argpartition`), так что для плотной матрицы N×N сложность
+# O(N²) (один линейный проход по каждой строке) плюс O(N·K log K) на упорядочение K лучших, а не O(N² log N).
+# При равенстве значений выше оказывается столбец с меньшим номером, т.е. более популярный курс.
+#
+# Для разреженной матрицы частичный выбор делается по ненулевым элементам строк.  Строки группируются
+# по длине (длина до 2, до 4, до 8, ...), каждая группа укладывается в плотный блок шириной в самую
+# длинную строку группы (не больше удвоенного числа её ненулевых элементов), и в блоке одним
+# `np.argpartition` находится K-е по величине значение каждой строки.  Полностью сортируются только
+# кандидаты не меньше этого порога — обычно это K элементов на строку, больше только при равенствах
+# на границе.  Итого O(nnz + N·K log K) вместо сортировки всех nnz элементов.  Плотная матрица дробных
+# весов (затухание по времени, метрики) обрабатывается как разреженная: ключ сортировки плотного
+# варианта рассчитан на целые значения.
+# %%
+def top_k_partners(matrix: "np.ndarray or scipy.sparse matrix", k: int) -> (np.ndarray, np.ndarray):
+    """Для каждой строки матрицы находит K столбцов с наибольшими значениями.
+    Параметры: 1) квадратная матрица (плотная или разреженная), 2) K.
+    Возвращает кортеж из двух массивов N×K: номера столбцов и значения, по убыванию значений.
+    Если в строке меньше K кандидатов, остаток заполняется номером -1 и значением 0."""
+    if sparse.issparse(matrix) or np.asarray(matrix).dtype.kind == 'f':
+        return _top_k_sparse(sparse.csr_matrix(matrix), k)
+    matrix = np.asarray(matrix)
+    n_rows, n_cols = matrix.shape
+    kk = min(k, n_cols)
+    # Ключ сортировки: значение, а при равенстве — меньший номер столбца.  Все ключи различны,
+    # поэтому результат частичного выбора не зависит от порядка обхода.
+    keys = matrix.astype(np.int64) * n_cols + np.arange(n_cols - 1, -1, -1)
+    cols = np.argpartition(keys, n_cols - kk, axis=1)[:, n_cols - kk:]
+    order = np.argsort(-np.take_along_axis(keys, cols, axis=1), axis=1)
+    cols = np.take_along_axis(cols, order, axis=1)
+    values = np.take_along_axis(matrix, cols, axis=1)
+    if kk < k:
+        cols = np.hstack([cols, np.full((n_rows, k - kk), -1, dtype=cols.dtype)])
+        values = np.hstack([values, np.zeros((n_rows, k - kk), dtype=values.dtype)])
+    return cols, values
+
+def _top_k_sparse(matrix: sparse.csr_matrix, k: int) -> (np.ndarray, np.ndarray):
+    "Вариант top_k_partners для разреженной CSR матрицы: частичный выбор по блокам строк близкой длины"
+    n_rows = matrix.shape[0]
+    cols = np.full((n_rows, k), -1, dtype=np.int64)
+    values = np.zeros((n_rows, k), dtype=matrix.dtype)
+    lengths = np.diff(matrix.indptr)
+    if k <= 0 or not lengths.any():
+        return cols, values
+    buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+    cand_rows, cand_pos = [], []
+    for bucket in np.unique(buckets[lengths > 0]):
+        rows = np.flatnonzero((buckets == bucket) & (lengths > 0))
+        width = int(lengths[rows].max())
+        valid = np.arange(width) < lengths[rows, None]
+        pos = np.where(valid, matrix.indptr[rows, None] + np.arange(width), 0)
+        block = np.where(valid, matrix.data[pos].astype(np.float64), -np.inf)
+        kk = min(k, width)
+        threshold = np.partition(block, width - kk, axis=1)[:, width - kk]
+        # кандидаты: не меньше K-го по величине значения (все равные ему тоже — порядок решит номер столбца)
+        take = valid & (block >= threshold[:, None])
+        cand_rows.append(np.broadcast_to(rows[:, None], take.shape)[take])
+        cand_pos.append(pos[take])
+    rows, pos = np.concatenate(cand_rows), np.concatenate(cand_pos)
+    order = np.lexsort((matrix.indices[pos], -matrix.data[pos].astype(np.float64), rows))
+    rows, pos = rows[order], pos[order]
+    starts = np.searchsorted(rows, rows, side='left')  # начало группы строки среди кандидатов
+    rank = np.arange(len(rows)) - starts
+    keep = rank < k
+    cols[rows[keep], rank[keep]] = matrix.indices[pos[keep]]
+    values[rows[keep], rank[keep]] = matrix.data[pos[keep]]
+    return cols, values
+
+# %% [markdown]
+# Метрики связи курсов.  Сырое число пар выводит наверх самые популярные курсы (551, 566) почти
+# в каждой строке.  Метрики ниже нормируют число пар $c_{ab}$ на популярность курсов $c_a$, $c_b$
+# (число покупателей из `ids_count`), считаются одним векторным проходом по ненулевым элементам
+# матрицы пар, без запросов к базе:
+#
+# - `confidence` — $c_{ab} / c_a$, доля покупателей курса $a$, купивших и $b$ (в строке порядок тот же, что у `count`);
+# - `lift` — $c_{ab} N / (c_a c_b)$, во сколько раз пара встречается чаще, чем при независимых покупках;
+# - `jaccard` — $c_{ab} / (c_a + c_b - c_{ab})$;
+# - `pmi` — $\log$ от `lift`.
+#
+# $N$ — общее число покупателей.  Внутри строки $N$ и $c_a$ постоянны, поэтому на порядок рекомендаций
+# $N$ не влияет, и по умолчанию он равен 1 (значения `lift` и `pmi` тогда верны с точностью до множителя и
+# слагаемого).  Кандидаты с числом пар не больше порога непопулярности в ранжирование не попадают —
+# иначе `lift` выводит наверх случайные пары редких курсов.
+# %%
+METRICS = {
+    'count': lambda c, ca, cb, n: c,
+    'confidence': lambda c, ca, cb, n: c / ca,
+    'lift': lambda c, ca, cb, n: c * n / (ca * cb),
+    'jaccard': lambda c, ca, cb, n: c / (ca + cb - c),
+    'pmi': lambda c, ca, cb, n: np.log(c * n / (ca * cb)),
+}
+
+def association_scores(matrix: "np.ndarray or scipy.sparse matrix", marginals: "array of buyer counts",
+                       metric='lift', n_buyers=1, min_count=1) -> sparse.csr_matrix:
+    """Считает метрику связи для всех пар курсов.
+    Параметры:
+        1) квадратная матрица числа пар (плотная или разреженная);
+        2) число покупателей каждого курса, в порядке строк матрицы;
+        3) метрика (см. METRICS);
+        4) общее число покупателей N;
+        5) пары, встретившиеся реже min_count раз, отбрасываются.
+    Возвращает разреженную CSR матрицу значений метрики (float64) для оставшихся пар."""
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric {metric!r}, expected one of {sorted(METRICS)}")
+    counts = sparse.coo_matrix(matrix)
+    keep = counts.data >= max(min_count, 1)
+    rows, cols = counts.row[keep], counts.col[keep]
+    c = counts.data[keep].astype(np.float64)
+    marginals = np.asarray(marginals, dtype=np.float64)
+    scores = METRICS[metric](c, marginals[rows], marginals[cols], float(n_buyers))
+    return sparse.csr_matrix((scores, (rows, cols)), shape=counts.shape)
+
 # %% [markdown]
 # Функция возвращает датафрейм с рекомендуемыми курсами. Структура датафрейма: индекс - курс,
 # к которому даётся рекомендация, первая колонка (first_rec) — первая рекомендация, вторая
 # колонка — вторая рекомендация.  Например, если результат вызова сохранён в переменной `res`, то
 # для получения обеих рекомендаций к курсу 489 нужно вызвать: `res.loc[489]`, для получения
 # только первой — `res.loc[489, 'first_rec']`, для второй —`res.loc[289, 'second_rec']`.
+#
+# Замена непопулярных кандидатов делается масками сразу для всей таблицы: значения K лучших партнёров
+# упорядочены по убыванию, поэтому «прошедшие порог» кандидаты всегда идут первыми, а оставшиеся
+# места по порядку занимают самые популярные курсы.  Для K=2 это в точности прежнее правило:
+# второй кандидат непопулярен — вместо него самый популярный курс; оба непопулярны — два самых популярных.
+# Для других метрик (`metric`) непопулярные пары отбрасываются ещё до выбора, остальное так же.
+# %%
+def recommend_top_k(matrix: "np.ndarray or scipy.sparse matrix", course_ids: "pd.Index of course IDs",
+                    freq_courses: "Series of courses by popularity", k=RECS_COUNT,
+                    metric='count', n_buyers=1) -> pd.DataFrame:
+    """ Строит таблицу из K рекомендаций по матрице частоты пар курсов.
+    Параметры:
+        1) Квадратная матрица пар курсов (плотная или разреженная).
+        2) pd.Index с ID курсов, соответствующих строкам и столбцам матрицы.
+        3) Series, в которой собраны курсы по порядку убывания популярности.
+        4) K — количество рекомендаций на курс.
+        5) Метрика, по которой ранжируются кандидаты (см. METRICS), по умолчанию число пар.
+        6) Общее число покупателей (нужно только для значений lift и pmi, на порядок не влияет).
+    Возвращает:
+        pd.DataFrame с ID курса в индексе и K колонками рекомендаций (см. rec_columns)
+    """
+    threshold = get_unpopular_threshold(freq_courses)
+    if metric == 'count':
+        cols, values = top_k_partners(matrix, k)
+        popular = values > threshold
+    else:
+        marginals = freq_courses.reindex(course_ids).fillna(0).to_numpy()
+        scores = association_scores(matrix, marginals, metric, n_buyers, min_count=threshold + 1)
+        cols, _ = top_k_partners(scores, k)
+        popular = cols >= 0
+    ids = course_ids.to_numpy()
+    partners = np.where(popular, ids[cols], -1)
+    recs = np.where(popular, partners, _popular_fallback(freq_courses.index.to_numpy(), ids, partners, ~popular))
+    return pd.DataFrame(recs.astype(np.uint32), index=course_ids, columns=rec_columns(k))
+
+# %% [markdown]
+# Замена непопулярных кандидатов: в строке может быть занято не больше K мест и есть сам курс, так что
+# среди K + 1 самых популярных курсов всегда найдётся достаточно свободных.  Для каждой строки
+# свободные кандидаты переставляются вперёд (устойчивая сортировка сохраняет порядок популярности),
+# и j-е место замены получает j-го из них.  Если курсов в каталоге не больше K, повторы неизбежны.
 # %%
-def get_recommended_courses(pairs_df, freq_courses) -> pd.DataFrame:
+def _popular_fallback(by_popularity: np.ndarray, course_ids: np.ndarray, partners: np.ndarray,
+                      replace: np.ndarray) -> np.ndarray:
+    """Курсы для замены непопулярных кандидатов, массив N×K.  Параметры: 1) ID курсов по убыванию
+    популярности, 2) ID курсов строк, 3) выбранные партнёры (N×K, -1 — места нет),
+    4) маска мест, которые нужно заменить"""
+    k = partners.shape[1]
+    top = by_popularity[:k + 1]
+    taken = (top[None, :, None] == partners[:, None, :]).any(axis=2) | (top[None, :] == course_ids[:, None])
+    free = np.argsort(taken, axis=1, kind='stable')  # сначала свободные кандидаты, по популярности
+    slot = np.minimum(np.cumsum(replace, axis=1) - 1, len(top) - 1)
+    return top[np.take_along_axis(free, np.maximum(slot, 0), axis=1)]
+
+# %%
+def get_recommended_courses(pairs_df, freq_courses, k=RECS_COUNT, metric='count') -> pd.DataFrame:
     """ Функция строит массив рекомендаций по данным, и таблице частоты пар курсов.
     Параметры:
         1) DataFrame пар курсов, где идентификаторы по вертикали и горизонтали, количество пар на пересечениях.
         2) Series, в которой собраны курсы по порядку убывания популярности.
+        3) K — количество рекомендаций на курс, по умолчанию две.
+        4) Метрика ранжирования (см. METRICS), по умолчанию число пар.
     Возвращает:
-        pd.DataFrame с ID курса в индексе, рекомендациями в колонках 'first_rec' и 'second_rec'.
+        pd.DataFrame с ID курса в индексе, рекомендациями в колонках 'first_rec', 'second_rec', ...
         Сортировка по обеим осям по убыванию популярности курсов
     """
-    threshold = get_unpopular_threshold(freq_table)
-    res = pd.DataFrame(index=pairs_df.index, dtype=np.uint32)
-    for (row_idx, courses_paired) in pairs_df.iterrows(): 
-        max_two = courses_paired.sort_values(ascending=False)[0:2]
-        # И тут вспоминаю, что есть ограничение "курс слишком непопулярный". 
-        # У нас max_two.iloc[0] >= max_two.iloc[1]
-        if max_two.iloc[1] > threshold:
-            res.loc[row_idx, 'first_rec']  = max_two.index[0]
-            res.loc[row_idx, 'second_rec'] = max_two.index[1]
-        elif max_two.iloc[0] > threshold:
-            res.loc[row_idx, 'first_rec']  = max_two.index[0]
-            res.loc[row_idx, 'second_rec'] = freq_courses.index[0]
-        else:
-            res.loc[row_idx, 'first_rec']  = freq_courses.index[0]
-            res.loc[row_idx, 'second_rec'] = freq_courses.index[1]
-    return res.astype(np.uint32)
+    return recommend_top_k(pairs_df.to_numpy(), pairs_df.index, freq_courses, k, metric)
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
+# %% [markdown]
+# #### Рекомендации по сегментам <a name='segments'/>
+# %% [markdown]
+# Отдельные таблицы рекомендаций для сегментов покупок: по промокоду, по году покупки или по когорте
+# покупателя (году его первой покупки).  Запускать программу для каждого сегмента отдельно —
+# значит N раз прочесть одни и те же данные из базы.  Вместо этого отношение `user_course_pairs`
+# читается один раз, с дополнительной колонкой — номером сегмента (COPY в двоичном формате, три
+# колонки int4).  Строки раскладываются по сегментам одной сортировкой, и для каждого сегмента
+# популярность, пары и таблица из K рекомендаций считаются по его массивам.  Сегменты
+# обрабатываются в пуле процессов.  Результат — одна общая таблица с сегментом в первой колонке
+# индекса, она выдаётся в любом формате, кроме `npy`.
+#
+# Пары считаются внутри сегмента: курсы, купленные одним пользователем в разных сегментах
+# (например, в разные годы), пару не образуют.  Покупки без промокода попадают в сегмент 0.
+# %%
+SEGMENTS = {
+    'promo': "coalesce(c.promo_code_id, 0)",
+    'year': "extract(year from coalesce(c.purchased_at, c.updated_at))",
+    'cohort': "extract(year from min(coalesce(c.purchased_at, c.updated_at)) over (partition by c.user_id))",
+}
+
+SEGMENTED_USER_COURSE_QUERY = """\
+select c.user_id::int4, i.resource_id::int4 as course_id, ({segment})::int4 as segment
+from
+    final.carts as c
+    join final.cart_items as i
+    on c.id = i.cart_id
+where
+    i.resource_type = 'Course'
+    and
+    c.state = 'successful'
+    and
+    c.user_id is not null
+"""
+
+def copy_segmented_user_courses(cursor, segment: str) -> (np.ndarray, np.ndarray, np.ndarray):
+    """Выгружает пары «пользователь — курс» вместе с номером сегмента (см. SEGMENTS) одним запросом.
+    Возвращает три массива одинаковой длины: user_id, course_id и segment"""
+    if segment not in SEGMENTS:
+        raise ValueError(f"Unknown segment '{segment}', expected one of: {', '.join(SEGMENTS)}")
+    return _copy_int4_columns(cursor, SEGMENTED_USER_COURSE_QUERY.format(segment=SEGMENTS[segment]), 3)
+
+def split_segments(users: np.ndarray, courses: np.ndarray, segments: np.ndarray):
+    "Генератор: (сегмент, user_id, course_id) для каждого сегмента, по возрастанию номера сегмента"
+    if not len(segments):
+        return
+    order = np.argsort(segments, kind='stable')
+    for part in np.split(order, np.flatnonzero(np.diff(segments[order])) + 1):
+        yield int(segments[part[0]]), users[part], courses[part]
+
+def _segment_recommendations(task: tuple) -> (int, pd.DataFrame):
+    """Таблица рекомендаций одного сегмента в отдельном процессе.
+    Параметр: кортеж (сегмент, user_id, course_id, K, метрика)"""
+    (segment, users, courses, k, metric) = task
+    freq_courses = freq_series(count_buyers_from_arrays(users, courses))
+    matrix = make_pairs_matrix(count_pairs_from_arrays(users, courses), freq_courses.index)
+    return segment, recommend_top_k(matrix, freq_courses.index, freq_courses, k, metric)
+
+def segmented_recommendations(users: np.ndarray, courses: np.ndarray, segments: np.ndarray,
+                              k=RECS_COUNT, metric='count', workers=PAIRS_WORKERS) -> pd.DataFrame:
+    """Таблицы рекомендаций для всех сегментов.  Параметры: 1-3) массивы user_id, course_id
+    и номеров сегментов, 4) K, 5) метрика ранжирования, 6) количество параллельных процессов.
+    Возвращает общую таблицу с индексом (segment, ID курса)"""
+    tasks = ((segment, seg_users, seg_courses, k, metric)
+             for (segment, seg_users, seg_courses) in split_segments(users, courses, segments))
+    if workers <= 1:
+        tables = dict(map(_segment_recommendations, tasks))
+    else:
+        with multiprocessing.Pool(workers) as pool:
+            tables = dict(pool.imap_unordered(_segment_recommendations, tasks))
+    if not tables:
+        return pd.DataFrame(columns=rec_columns(k), dtype=np.uint32,
+                            index=pd.MultiIndex.from_arrays([[], []], names=['segment', None]))
+    return pd.concat(tables, names=['segment', None]).sort_index()
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
+# %% [markdown]
+# #### Загрузка данных <a name='load_data'/>
+# %% [markdown]
+# Счётчики курсов и пар можно получить из снимка, из инкрементального состояния или полным
+# пересчётом по базе.  Эта функция собирает все варианты вместе, ей пользуются и ноутбук, и
+# [командная строка](#batch).
+# %%
+def load_counts(snapshot_file=None, state_file=None, materialize=False, engine=PAIRS_ENGINE,
+                workers=PAIRS_WORKERS, itersize=ITERSIZE, use_snapshot=True, source=None,
+                half_life=None, window=None, engine_options=None) -> (Counter, Counter):
+    """Возвращает кортеж (счётчик популярности курсов, счётчик пар курсов).
+    Параметры:
+        1) snapshot_file — файл снимка данных: если он есть и use_snapshot, данные берутся из него,
+           иначе считаются по базе и записываются в него;
+        2) state_file — файл состояния для инкрементального обновления (необязательно);
+        3) materialize — работать с единым снимком базы (временная таблица user_course_pairs);
+        4-6) engine, workers, itersize — параметры подсчёта пар;
+        7) source — локальный источник данных (LocalSource) вместо базы;
+        8-9) half_life, window — взвешенные по времени счётчики (дни, нужен state_file);
+        10) engine_options — дополнительные параметры движка подсчёта пар."""
+    if snapshot_file and use_snapshot and os.path.exists(snapshot_file):
+        with stage('load_snapshot'):
+            ids_count, pairs_matrix, course_ids = load_snapshot(snapshot_file)
+            return ids_count, pairs_count_from_matrix(pairs_matrix, course_ids)
+    if (half_life or window) and not state_file:
+        raise ValueError("Time-weighted counts are maintained incrementally and need a state file")
+    if source is not None:
+        if state_file or materialize:
+            raise ValueError("Incremental and materialized modes need the Postgres database")
+        ids_count = get_cids_by_popularity(source)
+        with stage('pairs'):
+            pairs_count = get_ids_pairs_counts_from_db(source, engine=engine, engine_options=engine_options)
+        if snapshot_file:
+            with stage('save_snapshot'):
+                save_snapshot(snapshot_file, ids_count, pairs_count)
+        return ids_count, pairs_count
+    if materialize and workers > 1:
+        # Параллельные процессы работают в своих соединениях: ни временной таблицы, ни снимка они не видят
+        raise ValueError("Materialized mode reads one database snapshot and cannot be combined with workers > 1")
+    with stage('connect'):
+        cursor = init_connect(DB_CONNECT_STRING)
+    try:
+        with stage('materialize' if materialize else 'transaction'), \
+             (materialized_snapshot(cursor) if materialize else nullcontext(cursor)):
+            # Проверка CTE — полный проход по корзинам с ожиданиями для данных 2017-2018 годов; при
+            # инкрементальном обновлении она свела бы выигрыш на нет, её можно запустить через validate
+            if not state_file:
+                with stage('check_ctes'):
+                    check_ctes(cursor)
+            if state_file:
+                with stage('incremental_update'):
+                    state = update_incremental_state(
+                        cursor, load_incremental_state(state_file, half_life, window), itersize)
+                    save_incremental_state(state, state_file)
+                if state.get('weighted'):
+                    ids_count, pairs_count = weighted_counts(state['weighted'])
+                else:
+                    ids_count, pairs_count = state['ids_count'], state['pairs_count']
+            elif engine == 'sparse' and workers <= 1:
+                with stage('pairs'):
+                    ids_count, pairs_count = counts_from_cooccurrence(
+                        *cooccurrence_from_arrays(*copy_user_courses(cursor)))
+            else:
+                with stage('popularity'):
+                    ids_count = get_cids_by_popularity(cursor)
+                with stage('pairs'):
+                    pairs_count = get_ids_pairs_counts_from_db(cursor, itersize, engine, workers,
+                                                               engine_options=engine_options)
+    finally:
+        cursor.connection.close()
+    if snapshot_file:
+        with stage('save_snapshot'):
+            save_snapshot(snapshot_file, ids_count, pairs_count)
+    return ids_count, pairs_count
 
 # %% [markdown]
 # | [К оглавлению](#contents) | [К началу раздела](#program)  |
@@ -622,14 +2269,14 @@ def get_recommended_courses(pairs_df, freq_courses) -> pd.DataFrame:
 # %% [markdown]
 # #### Функция для интерактивной работы (Jupyter notebook или iPython) <a name='interactive'/>
 # %%
-def interactive_work(course_pairs_df):
+def interactive_work(course_pairs_df, ids_count, pairs_count, freq_courses, snapshot_file=None):
     """Программа работает в интерактивном режиме. Выводим все данные в ноутбук,
     строим графики и т. п."""
     init_graphics()
     print_tops(ids_count, pairs_count)
-    plot_top_courses(ids_count)
-    show_heatmap_pairs(course_pairs_df)
-    res = get_recommended_courses(course_pairs_df, freq_table)
+    plot_top_courses(freq_courses)
+    show_heatmap_pairs(course_pairs_df, snapshot_file)
+    res = get_recommended_courses(course_pairs_df, freq_courses)
     print("Можно вывести обе рекомендации для одного или нескольких курсов таблицей:\n",
            res.loc[489])
     print("Или использовать конкретные поля, например, так:" + "\n" +
@@ -639,31 +2286,541 @@ def interactive_work(course_pairs_df):
     return
 
 # %% [markdown]
-# #### Функция для пакетной работы <a name='batch'/>
-# %% [markdown] 
-# Выдача рекомендаций в CSV формате на стандартный вывод.
+# #### Кэш результатов <a name='result_cache'/>
+# %% [markdown]
+# Пакетный запуск пересчитывает популярность, пары, матрицу и рекомендации, даже если `final.carts`
+# с прошлого запуска не менялась (в выходные, или когда задание запускают несколько потребителей).
+# Кэш результатов хранит готовые таблицы рекомендаций в каталоге, по одному файлу на ключ.  Ключ —
+# хэш от двух частей:
+#
+# - отпечатка исходных данных: для базы — число строк, максимальные `id` и `updated_at` таблиц
+#   `final.carts` и `final.cart_items` (один короткий запрос вместо расчёта), для локальных выгрузок
+#   и снимка — размер и время изменения файлов;
+# - параметров расчёта, от которых зависит результат: K, метрика, квантиль непопулярности,
+#   режим последовательностей, взвешивание по времени и параметры приближённого движка.
+#
+# Если ключ найден, таблица выдаётся из кэша, и расчёт не выполняется.  Инкрементальное состояние
+# при этом не обновляется: данные не менялись, обновлять нечего.  Запуск `build` со снимком (`--snapshot`)
+# кэш не использует — снимок нужно записать заново.  После записи новой таблицы старые удаляются:
+# сначала те, что не использовались дольше `max_age` дней, затем самые давно использованные, пока
+# каталог не уложится в `max_bytes`.  Время использования — время изменения файла, при попадании
+# в кэш оно обновляется.
 # %%
-def packet_job(course_pairs_df):
-    """Программа вызвана в пакетном режиме, печать таблицы на STDOUT и выход"""
-    print(get_recommended_courses(course_pairs_df, freq_table).sort_index().to_csv(index_label="course_ID"))
+CACHE_VERSION = 1  # меняется, если меняется способ расчёта рекомендаций
+CACHE_MAX_BYTES = 256 * 2 ** 20
+CACHE_MAX_AGE_DAYS = 7
+
+SOURCE_FINGERPRINT_QUERY = """\
+select 'carts' as name, count(*) as rows, max(id) as max_id, max(updated_at) as max_updated_at
+from final.carts
+union all
+select 'cart_items', count(*), max(id), max(updated_at)
+from final.cart_items
+"""
+
+def source_fingerprint(cursor: "PsycoPg2 cursor or LocalSource") -> list:
+    "Дешёвый отпечаток исходных данных: меняется, если в таблицах carts или cart_items что-то изменилось"
+    if isinstance(cursor, LocalSource):
+        return cursor.fingerprint()
+    cursor.execute(SOURCE_FINGERPRINT_QUERY)
+    return [[row.name, row.rows, row.max_id, str(row.max_updated_at)] for row in cursor.fetchall()]
+
+def result_cache_key(fingerprint: list, params: dict) -> str:
+    "Ключ кэша по отпечатку исходных данных и параметрам расчёта"
+    key_data = json.dumps({'version': CACHE_VERSION, 'fingerprint': fingerprint, 'params': params},
+                          sort_keys=True, default=str)
+    return hashlib.sha256(key_data.encode()).hexdigest()[:32]
+
+def _cache_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, key + '.pkl')
+
+def load_cached_result(cache_dir: str, key: str) -> pd.DataFrame:
+    "Таблица рекомендаций из кэша или None, если её там нет"
+    path = _cache_path(cache_dir, key)
+    try:
+        with open(path, 'rb') as cache_file:
+            recs = pickle.load(cache_file)
+    except FileNotFoundError:
+        return None
+    os.utime(path)  # отметка использования для вытеснения
+    return recs
+
+def store_cached_result(cache_dir: str, key: str, recs: pd.DataFrame,
+                        max_bytes=CACHE_MAX_BYTES, max_age_days=CACHE_MAX_AGE_DAYS):
+    "Сохраняет таблицу рекомендаций в кэш и вытесняет старые записи (см. evict_cache)"
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, key)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as cache_file:
+        pickle.dump(recs, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict_cache(cache_dir, max_bytes, max_age_days)
     return
 
+def evict_cache(cache_dir: str, max_bytes=CACHE_MAX_BYTES, max_age_days=CACHE_MAX_AGE_DAYS) -> int:
+    """Удаляет записи кэша, не использованные дольше max_age_days дней, затем самые давно
+    использованные, пока общий размер больше max_bytes.  Возвращает число удалённых записей"""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.pkl'):
+            info = entry.stat()
+            entries.append((info.st_mtime, info.st_size, entry.path))
+    entries.sort(reverse=True)  # сначала недавно использованные
+    oldest = time.time() - max_age_days * DAY_SECONDS
+    total, removed = 0, 0
+    for (mtime, size, path) in entries:
+        total += size
+        if mtime < oldest or total > max_bytes:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass  # запись уже удалил параллельный запуск
+            total -= size
+    return removed
+
+# %% [markdown]
+# | [К оглавлению](#contents) | [К началу раздела](#program)  |
+# |:---|---:|
+
+# %% [markdown]
+# #### Функции для пакетной работы <a name='batch'/>
+# %% [markdown]
+# Выдача рекомендаций в CSV формате на стандартный вывод (или в файл).  В пакетном режиме
+# плотная таблица пар не строится, рекомендации считаются прямо по разреженной матрице.
+#
+# Кроме CSV, таблицу можно выдать в форматах, которые потребителям не нужно разбирать построчно:
+#
+# - `parquet` — колоночный файл Parquet (нужен pyarrow), те же колонки, что в CSV;
+# - `npy` — массив int32 формата NumPy `.npy` размером (max_ID + 1) × K, номер строки — ID курса,
+#   пустые строки заполнены `NO_COURSE`.  Читатель открывает его через `np.load(path, mmap_mode='r')`
+#   без разбора и копирования: поиск рекомендаций — одно обращение к массиву по индексу
+#   (так его читает `final_proj_rec_server.py`);
+# - `postgres` — таблица в базе (`-o` — имя таблицы, можно со схемой; при первой выдаче она создаётся).
+#   Строки загружаются командой COPY в двоичном формате во временную таблицу, и в той же транзакции
+#   таблица обновляется: изменившиеся и новые строки — `insert ... on conflict do update`, строки
+#   исчезнувших курсов удаляются.  Сама таблица не пересоздаётся, так что права (GRANT), комментарии
+#   и представления над ней сохраняются.  Читатели видят либо старое содержимое целиком, либо новое.
+#
+# Файлы пишутся через временный файл и переименование, как снимок данных, чтобы сервис не прочёл
+# таблицу наполовину записанной.  Общая таблица [по сегментам](#segments) выдаётся с дополнительной
+# первой колонкой `segment` (в CSV, Parquet и Postgres; файл `npy` вмещает только одну таблицу).
+# %%
+NO_COURSE = -1
+
+def index_labels(recs: pd.DataFrame) -> "str or list":
+    "Названия колонок индекса таблицы рекомендаций при выдаче: ID курса и, для сегментов, сегмент"
+    return ['segment', 'course_ID'] if isinstance(recs.index, pd.MultiIndex) else 'course_ID'
+
+def write_csv(recs: pd.DataFrame, output=None):
+    "Печатает таблицу рекомендаций в CSV формате в файл output (путь или открытый файл), по умолчанию на STDOUT"
+    text = recs.sort_index().to_csv(index_label=index_labels(recs))
+    if not isinstance(output, str):
+        print(text, file=output or sys.stdout)
+        return
+    tmp_path = output + '.tmp'
+    with open(tmp_path, 'w') as out:
+        print(text, file=out)
+    os.replace(tmp_path, output)
+    return
+
+def write_parquet(recs: pd.DataFrame, path: str):
+    "Записывает таблицу рекомендаций в файл Parquet: колонка course_ID (и segment) и колонки рекомендаций"
+    tmp_path = path + '.tmp'
+    recs.sort_index().rename_axis(index_labels(recs)).reset_index().to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return
+
+def lookup_array(recs: pd.DataFrame) -> np.ndarray:
+    "Массив int32 (max_ID + 1) × K, индексированный ID курса; строки без курса заполнены NO_COURSE"
+    if isinstance(recs.index, pd.MultiIndex):
+        raise ValueError("A lookup file holds one table, use csv, parquet or postgres for segments")
+    course_ids = recs.index.to_numpy()
+    table = np.full((int(course_ids.max(initial=-1)) + 1, recs.shape[1]), NO_COURSE, dtype=np.int32)
+    table[course_ids] = recs.to_numpy()
+    return table
+
+def write_lookup_file(recs: pd.DataFrame, path: str):
+    "Записывает таблицу рекомендаций в файл .npy для чтения через np.load(path, mmap_mode='r')"
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as lookup_file:
+        np.save(lookup_file, lookup_array(recs))
+    os.replace(tmp_path, path)
+    return
+
+def pgcopy_int4_rows(columns: "list of int arrays") -> bytes:
+    "Поток COPY в двоичном формате для строк из нескольких полей int4 (колонки одинаковой длины)"
+    rows = np.empty(len(columns[0]) if columns else 0, dtype=pgcopy_int4_row(len(columns)))
+    rows['fields'] = len(columns)
+    for i, column in enumerate(columns):
+        rows[f'len_{i}'] = 4
+        rows[f'value_{i}'] = column
+    return PGCOPY_SIGNATURE + bytes(8) + rows.tobytes() + b'\xff\xff'  # флаги и длина расширения заголовка — нули
+
+def write_postgres(recs: pd.DataFrame, table: str, conn_string=None):
+    """Загружает таблицу рекомендаций в таблицу базы (имя можно указать со схемой: schema.table):
+    одной транзакцией обновляет изменившиеся строки, добавляет новые и удаляет лишние.
+    Параметры: 1) таблица рекомендаций, 2) имя таблицы,
+    3) строка подключения с правом записи (по умолчанию DB_CONNECT_STRING)"""
+    from psycopg2 import sql
+    *schema, name = table.split('.')
+    target, loaded = sql.Identifier(*schema, name), sql.Identifier(name + '_load')
+    keys = ['segment', 'course_id'] if isinstance(recs.index, pd.MultiIndex) else ['course_id']
+    names = keys + list(recs.columns)
+    columns = sql.SQL(', ').join(
+        [sql.SQL("{} integer not null").format(sql.Identifier(key)) for key in keys]
+        + [sql.SQL("{} integer").format(sql.Identifier(column)) for column in recs.columns])
+    column_list = sql.SQL(', ').join(map(sql.Identifier, names))
+    key_list = sql.SQL(', ').join(map(sql.Identifier, keys))
+    updates = sql.SQL(', ').join(sql.SQL("{0} = excluded.{0}").format(sql.Identifier(column))
+                                 for column in recs.columns)
+    recs_list = sql.SQL(', ').join(sql.SQL("t.{}").format(sql.Identifier(column)) for column in recs.columns)
+    excluded_list = sql.SQL(', ').join(sql.SQL("excluded.{}").format(sql.Identifier(column))
+                                       for column in recs.columns)
+    same_keys = sql.SQL(' and ').join(sql.SQL("n.{0} = t.{0}").format(sql.Identifier(key)) for key in keys)
+    recs = recs.sort_index()
+    data = pgcopy_int4_rows([recs.index.get_level_values(i).to_numpy() for i in range(len(keys))]
+                            + [recs[column].to_numpy() for column in recs.columns])
+    conn = psycopg2.connect(conn_string or DB_CONNECT_STRING)
+    try:
+        with conn, conn.cursor() as cursor:  # одна транзакция: при ошибке таблица остаётся как была
+            cursor.execute(sql.SQL("create table if not exists {} ({}, primary key ({}))").format(
+                target, columns, key_list))
+            cursor.execute(sql.SQL("create temporary table {} ({}) on commit drop").format(loaded, columns))
+            with stage('copy_out') as record:
+                cursor.copy_expert(sql.SQL("copy {} ({}) from stdin with (format binary)").format(
+                    loaded, column_list).as_string(conn), io.BytesIO(data))
+                if record is not None:
+                    record['rows'], record['bytes'] = len(recs), len(data)
+            # Неизменившиеся строки не переписываются: меньше мёртвых версий строк после каждой выдачи
+            cursor.execute(sql.SQL("""\
+insert into {target} as t ({columns}) select {columns} from {loaded}
+on conflict ({keys}) do update set {updates}
+where ({recs}) is distinct from ({excluded})""").format(
+                target=target, columns=column_list, loaded=loaded, keys=key_list, updates=updates,
+                recs=recs_list, excluded=excluded_list))
+            cursor.execute(sql.SQL("delete from {} as t where not exists (select from {} as n where {})").format(
+                target, loaded, same_keys))
+    finally:
+        conn.close()
+    return
+
+EXPORT_FORMATS = {
+    'csv': write_csv,
+    'parquet': write_parquet,
+    'npy': write_lookup_file,
+    'postgres': write_postgres,
+}
+
+def packet_job(freq_courses, pairs_matrix, k=RECS_COUNT, output=None, metric='count', fmt='csv', dsn=None):
+    """Программа вызвана в пакетном режиме, выдача таблицы (по умолчанию CSV на STDOUT).
+    Параметры: 1) Series с курсами по убыванию популярности, 2) разреженная матрица пар курсов
+    в том же порядке, 3) количество рекомендаций, 4) куда выдать таблицу: файл (путь или открытый файл)
+    или имя таблицы в базе, 5) метрика ранжирования, 6) формат (см. EXPORT_FORMATS),
+    7) строка подключения для формата postgres.  Возвращает таблицу рекомендаций"""
+    with stage('recommend'):
+        recs = recommend_top_k(pairs_matrix, freq_courses.index, freq_courses, k, metric)
+    export_table(recs, output, fmt, dsn)
+    return recs
+
+def segmented_packet_job(segment: str, k=RECS_COUNT, output=None, metric='count', fmt='csv', dsn=None,
+                         workers=PAIRS_WORKERS) -> pd.DataFrame:
+    """Пакетный режим по сегментам: одно чтение из базы, таблицы сегментов в пуле процессов и общая выдача.
+    Параметры: 1) вид сегментов (см. SEGMENTS), 2-6) как у packet_job, 7) количество процессов.
+    Возвращает общую таблицу рекомендаций"""
+    with stage('connect'):
+        cursor = init_connect(DB_CONNECT_STRING)
+    try:
+        users, courses, segments = copy_segmented_user_courses(cursor, segment)
+    finally:
+        cursor.connection.close()
+    with stage('recommend') as record:
+        recs = segmented_recommendations(users, courses, segments, k, metric, workers)
+        if record is not None:
+            record['segments'] = int(recs.index.get_level_values(0).nunique())
+    export_table(recs, output, fmt, dsn)
+    return recs
+
+def export_table(recs: pd.DataFrame, output=None, fmt='csv', dsn=None):
+    "Выдаёт готовую таблицу рекомендаций в заданном формате (параметры — как у packet_job)"
+    if fmt != 'csv' and not output:
+        raise ValueError(f"Output format {fmt} needs an output file or table name")
+    with stage('output'):
+        if fmt == 'postgres':
+            write_postgres(recs, output, dsn)
+        else:
+            EXPORT_FORMATS[fmt](recs, output)
+    return
+
+# %%
+def freq_series(ids_count: Counter) -> pd.Series:
+    "Series популярности курсов: ID курса в индексе, по убыванию числа покупок (или их веса)"
+    dtype = np.int64 if counts_dtype(ids_count).kind == 'u' else np.float64
+    return pd.Series(dict(ids_count.most_common()), dtype=dtype)
+
+# %% [markdown]
+# Командная строка.  Подкоманды:
+#
+# - `build` — посчитать данные по базе (полностью или инкрементально), при необходимости сохранить
+#   снимок и выдать таблицу рекомендаций;
+# - `export` — выдать таблицу рекомендаций по готовому снимку, без обращения к базе;
+# - `validate` — проверить CTE (и, по желанию, совпадение движков подсчёта пар) и бюджет холодного старта.
+#
+# Без подкоманды программа работает как `build` с параметрами по умолчанию: считает таблицу по базе и
+# печатает её на STDOUT, как до появления подкоманд.  Недопустимые сочетания параметров (`check_args`)
+# сообщаются как ошибки командной строки, до обращения к базе.
+#
+# Бюджет холодного старта: импорт модуля в пакетном режиме не должен занимать больше
+# `COLD_START_BUDGET` секунд и не должен загружать графические и ноутбучные модули.
+# `validate` при нарушении завершается с ошибкой, остальные подкоманды печатают предупреждение.
+# %%
+COLD_START_BUDGET = 1.5  # секунд
+LAZY_MODULES = ('matplotlib', 'seaborn', 'IPython')
+
+def check_cold_start(budget=COLD_START_BUDGET) -> list:
+    "Проверяет бюджет холодного старта, возвращает список нарушений (пустой, если всё хорошо)"
+    problems = []
+    if IMPORT_TIME > budget:
+        problems.append(f"module import took {IMPORT_TIME:.3f}s, budget is {budget:.3f}s")
+    loaded = [name for name in LAZY_MODULES if name in sys.modules]
+    if loaded:
+        problems.append("modules loaded at startup: " + ", ".join(loaded))
+    return problems
+
+def make_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Таблица рекомендаций курсов SkillFactory")
+    parser.add_argument('--startup-budget', type=float, default=COLD_START_BUDGET,
+                        help="бюджет холодного старта, секунд")
+    parser.add_argument('--report', help="записать отчёт о времени и памяти этапов в этот JSON файл")
+    parser.add_argument('--profile', help="записать профиль cProfile в этот файл")
+    commands = parser.add_subparsers(dest='command')
+
+    build = commands.add_parser('build', help="посчитать данные по базе и выдать таблицу рекомендаций")
+    build.add_argument('--snapshot', default=os.environ.get('RECOMMENDATIONS_SNAPSHOT'),
+                       help="сохранить снимок данных в этот файл (.npz)")
+    build.add_argument('--state-file', default=os.environ.get('RECOMMENDATIONS_STATE_FILE'),
+                       help="файл состояния для инкрементального обновления")
+    build.add_argument('--materialize', action='store_true',
+                       default=bool(os.environ.get('RECOMMENDATIONS_MATERIALIZE')),
+                       help="единый снимок базы: временная таблица user_course_pairs")
+    build.add_argument('--engine', choices=sorted(PAIRS_ENGINES), default=PAIRS_ENGINE,
+                       help="способ подсчёта пар")
+    build.add_argument('--workers', type=int, default=int(os.environ.get('RECOMMENDATIONS_WORKERS', PAIRS_WORKERS)),
+                       help="количество параллельных процессов подсчёта пар")
+    build.add_argument('--itersize', type=int, default=ITERSIZE, help="строк из базы за одно чтение")
+    build.add_argument('--sketch-width', type=int, default=SKETCH_WIDTH,
+                       help="движок approx: ширина скетча Count-Min (ошибка оценки не больше e/ширина от числа пар)")
+    build.add_argument('--sketch-depth', type=int, default=SKETCH_DEPTH,
+                       help="движок approx: глубина скетча (вероятность превысить ошибку не больше e^-глубина)")
+    build.add_argument('--sketch-candidates', type=int, default=SKETCH_CANDIDATES,
+                       help="движок approx: сколько кандидатов в партнёры хранить на курс")
+    weighting = build.add_mutually_exclusive_group()
+    weighting.add_argument('--half-life', type=float,
+                           help="затухание по времени: период полураспада веса покупки, дней (нужен --state-file)")
+    weighting.add_argument('--window', type=int,
+                           help="учитывать только покупки последних WINDOW дней (нужен --state-file)")
+    build.add_argument('--carts', help="читать данные не из базы, а из файла с таблицей carts (.parquet или .csv)")
+    build.add_argument('--cart-items', help="файл с таблицей cart_items (вместе с --carts)")
+    build.add_argument('--sqlite', help="читать данные не из базы, а из файла SQLite с таблицами carts и cart_items")
+    build.add_argument('--sequences', action='store_true',
+                       help="рекомендовать следующий курс по последовательностям покупок, а не пары курсов")
+    build.add_argument('--segment', choices=sorted(SEGMENTS),
+                       help="отдельные таблицы по сегментам (промокод, год покупки, когорта) в одной выдаче; "
+                            "сегменты считаются в --workers процессах")
+
+    export = commands.add_parser('export', help="выдать таблицу рекомендаций по снимку данных")
+    export.add_argument('--snapshot', required=True, help="файл снимка данных (.npz)")
+
+    for command in (build, export):
+        command.add_argument('-k', type=int, default=RECS_COUNT, help="количество рекомендаций на курс")
+        command.add_argument('-o', '--output',
+                             help="файл для таблицы (по умолчанию STDOUT), для формата postgres — имя таблицы")
+        command.add_argument('--format', dest='fmt', choices=list(EXPORT_FORMATS), default='csv',
+                             help="формат выдачи таблицы")
+        command.add_argument('--dsn', default=os.environ.get('RECOMMENDATIONS_DSN'),
+                             help="формат postgres: строка подключения с правом записи (по умолчанию та же база)")
+        command.add_argument('--metric', choices=sorted(METRICS), default='count',
+                             help="метрика ранжирования рекомендаций")
+        command.add_argument('--cache-dir', default=os.environ.get('RECOMMENDATIONS_CACHE_DIR'),
+                             help="каталог кэша результатов: при неизменных данных таблица берётся из него")
+        command.add_argument('--cache-max-mb', type=float, default=CACHE_MAX_BYTES / 2 ** 20,
+                             help="предельный размер кэша, МБ")
+        command.add_argument('--cache-max-age', type=float, default=CACHE_MAX_AGE_DAYS,
+                             help="удалять записи кэша, не использованные столько дней")
+
+    validate = commands.add_parser('validate', help="проверить данные в базе и бюджет холодного старта")
+    validate.add_argument('--engines', action='store_true', help="сравнить результаты всех движков подсчёта пар")
+    validate.add_argument('--no-db', action='store_true', help="не подключаться к базе")
+    return parser
+
+def check_args(args) -> list:
+    "Проверяет сочетания параметров подкоманд build и export, возвращает список ошибок (пустой, если всё хорошо)"
+    if args.command == 'validate':
+        return []
+    errors = []
+    if args.fmt != 'csv' and not args.output:
+        errors.append(f"--format {args.fmt} needs -o/--output (a file or, for postgres, a table name)")
+    if args.command == 'export':
+        return errors
+    local = bool(args.carts or args.cart_items or args.sqlite)
+    if bool(args.carts) != bool(args.cart_items):
+        errors.append("--carts and --cart-items must be given together")
+    if args.sqlite and args.carts:
+        errors.append("--sqlite cannot be combined with --carts/--cart-items")
+    if (args.half_life or args.window) and not args.state_file:
+        errors.append("--half-life and --window need --state-file")
+    if local and (args.state_file or args.materialize):
+        errors.append("--state-file and --materialize need the Postgres database")
+    if args.materialize and args.workers > 1:
+        errors.append("--materialize reads one database snapshot and cannot be combined with --workers > 1")
+    if args.engine in APPROX_ENGINES and args.workers > 1 and not local:
+        errors.append(f"--engine {args.engine} works in one process, use --workers 1")
+    if args.sequences and (args.snapshot or args.state_file or args.materialize):
+        errors.append("--sequences cannot be combined with --snapshot, --state-file or --materialize")
+    if args.sequences and args.carts:
+        errors.append("--sequences needs purchase times: use --sqlite or the database")
+    if args.segment and (args.snapshot or args.state_file or args.materialize or args.sequences
+                         or args.half_life or args.window):
+        errors.append("--segment cannot be combined with --snapshot, --state-file, --materialize, "
+                      "--sequences, --half-life or --window")
+    if args.segment and local:
+        errors.append("--segment needs the Postgres database")
+    return errors
+
+def main(argv=None) -> int:
+    """Точка входа для пакетного режима. Возвращает код завершения.
+    Без подкоманды работает как build (так программа запускалась до появления подкоманд)"""
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = make_arg_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(argv + ['build'])  # общие параметры стоят перед подкомандой
+    errors = check_args(args)
+    if errors:
+        parser.error("; ".join(errors))
+    if args.report:
+        start_run_report(args.command)
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        return run_command(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.report:
+            finish_run_report(args.report)
+
+def sketch_options(args) -> dict:
+    "Параметры движка approx из командной строки (для остальных движков — None)"
+    if args.engine not in APPROX_ENGINES:
+        return None
+    return {'width': args.sketch_width, 'depth': args.sketch_depth, 'candidates': args.sketch_candidates}
+
+def input_fingerprint(args) -> list:
+    "Отпечаток исходных данных подкоманды build или export (см. source_fingerprint)"
+    if args.command == 'export':
+        return file_fingerprint(args.snapshot)
+    source = open_local_source(args.carts, args.cart_items, args.sqlite)
+    if source is not None:
+        return source.fingerprint()
+    cursor = init_connect(DB_CONNECT_STRING)
+    try:
+        return source_fingerprint(cursor)
+    finally:
+        cursor.connection.close()
+
+def pipeline_params(args) -> dict:
+    "Параметры расчёта, от которых зависит таблица рекомендаций (вторая часть ключа кэша)"
+    build = args.command == 'build'
+    return {'command': args.command, 'k': args.k, 'metric': args.metric,
+            'unpopular_quantile': UNPOPULAR_QUANTILE,
+            'sequences': build and args.sequences, 'segment': build and args.segment,
+            'half_life': build and args.half_life, 'window': build and args.window,
+            'approx': build and sketch_options(args)}
+
+def run_command(args) -> int:
+    "Выполняет подкоманду по разобранным аргументам командной строки"
+    problems = check_cold_start(args.startup_budget)
+    if args.command == 'validate':
+        if not args.no_db:
+            cursor = init_connect(DB_CONNECT_STRING)
+            with stage('check_ctes'):
+                check_ctes(cursor)
+            if args.engines:
+                with stage('check_pairs_engines'):
+                    check_pairs_engines(cursor)
+            cursor.connection.close()
+        for problem in problems:
+            print("Cold start: " + problem, file=sys.stderr)
+        return 1 if problems else 0
+    for problem in problems:
+        print("Warning, cold start: " + problem, file=sys.stderr)
+    cache_key = None
+    if args.cache_dir and not (args.command == 'build' and args.snapshot):
+        with stage('cache_lookup') as record:
+            cache_key = result_cache_key(input_fingerprint(args), pipeline_params(args))
+            recs = load_cached_result(args.cache_dir, cache_key)
+            if record is not None:
+                record['hit'] = recs is not None
+        if recs is not None:
+            export_table(recs, args.output, args.fmt, args.dsn)
+            return 0
+    if args.command == 'build' and args.segment:
+        recs = segmented_packet_job(args.segment, args.k, args.output, args.metric, args.fmt, args.dsn, args.workers)
+    else:
+        recs = single_table_job(args)
+    if cache_key:
+        with stage('cache_store'):
+            store_cached_result(args.cache_dir, cache_key, recs, int(args.cache_max_mb * 2 ** 20), args.cache_max_age)
+    return 0
+
+def single_table_job(args) -> pd.DataFrame:
+    "Расчёт и выдача одной таблицы рекомендаций для подкоманд build и export. Возвращает таблицу"
+    if args.command == 'build' and args.sequences:
+        freq_courses, pairs_matrix = load_transitions(open_local_source(args.carts, args.cart_items, args.sqlite))
+    elif args.command == 'build':
+        source = open_local_source(args.carts, args.cart_items, args.sqlite)
+        ids_count, pairs_count = load_counts(args.snapshot, args.state_file, args.materialize,
+                                             args.engine, args.workers, args.itersize, use_snapshot=False,
+                                             source=source, half_life=args.half_life, window=args.window,
+                                             engine_options=sketch_options(args))
+        freq_courses = freq_series(ids_count)
+        with stage('matrix'):
+            pairs_matrix = make_pairs_matrix(pairs_count, freq_courses.index)
+    else:
+        with stage('load_snapshot'):
+            ids_count, pairs_matrix, course_ids = load_snapshot(args.snapshot)
+        freq_courses = freq_series(ids_count)  # порядок курсов в снимке совпадает с порядком популярности
+    if args.report:
+        with stage('summary'):
+            report_summary('popularity', summary_stats(freq_courses))
+            if not getattr(args, 'sequences', False):
+                report_summary('pairs', summary_stats(pairs_count_from_matrix(pairs_matrix, freq_courses.index)))
+    return packet_job(freq_courses, pairs_matrix, args.k, args.output, args.metric, args.fmt, args.dsn)
+
 # %% [markdown]
 # ### Основная точка входа в программу <a name='exec_point'/>
+# %% [markdown]
+# В ноутбуке данные берутся из снимка (если задан `RECOMMENDATIONS_SNAPSHOT` и файл есть) или из базы,
+# в пакетном режиме работает [командная строка](#batch).
 # %% [code]
 if __name__ == "__main__":
-    cursor = init_connect(DB_CONNECT_STRING)
-    check_ctes(cursor)
-    ids_count = get_cids_by_popularity(cursor)
-    pairs_count = get_ids_pairs_counts_from_db(cursor)
-    # Чтобы номера курсов были в индексе, а количество в значении, пары нужно перевести в словарь
-    freq_table = pd.Series({k:v for k,v in ids_count.most_common()})
-    course_pairs_df = make_freq_matrix(pairs_count)
     if is_interactive():
+        from IPython.display import HTML, display
+        ids_count, pairs_count = load_counts(
+            os.environ.get('RECOMMENDATIONS_SNAPSHOT'), os.environ.get('RECOMMENDATIONS_STATE_FILE'),
+            bool(os.environ.get('RECOMMENDATIONS_MATERIALIZE')),
+            workers=int(os.environ.get('RECOMMENDATIONS_WORKERS', PAIRS_WORKERS)))
+        # Чтобы номера курсов были в индексе, а количество в значении, пары нужно перевести в словарь
+        freq_table = pd.Series({k:v for k,v in ids_count.most_common()})
+        course_pairs_df = make_freq_matrix(pairs_count, freq_table)
         display(HTML('<a name="output"/>'))  # anchor for links
-        interactive_work(course_pairs_df)
+        interactive_work(course_pairs_df, ids_count, pairs_count, freq_table,
+                         os.environ.get('RECOMMENDATIONS_SNAPSHOT'))
     else:
-        packet_job(course_pairs_df)
+        sys.exit(main())
 
 # %% [markdown]
 # | [К оглавлению](#contents) | [К началу раздела](#program)  |